@@ -10,15 +10,14 @@ from app.models import Canal
 # Configurar la aplicación Flask
 app = create_app()
 
-with app.app_context():
+with app.test_request_context():
     try:
         # Importar las funciones necesarias
-        from app.routes import get_m3u_hash, m3u_hash
+        from app import routes as m3u_module
         
         # Actualizar el hash M3U
-        from app.routes import m3u_hash as m3u_module
-        new_hash = get_m3u_hash()
-        if new_hash != m3u_hash:
+        _, new_hash = m3u_module.obtener_m3u()
+        if new_hash != m3u_module.m3u_hash:
             m3u_module.m3u_hash = new_hash
             print(f"Hash M3U actualizado: {new_hash}")
         else:
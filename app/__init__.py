@@ -30,6 +30,16 @@ def create_app():
     os.makedirs(app.config['TRANSCODED_FOLDER'], exist_ok=True)
     os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)
     
+    # Directorio de logs de FFmpeg (app/logs, el que crea setup.py): se crea y se
+    # verifica una sola vez al arrancar en lugar de en cada inicio de transmisión
+    app.config['LOGS_FOLDER'] = os.path.join(app.root_path, 'logs')
+    try:
+        os.makedirs(app.config['LOGS_FOLDER'], exist_ok=True)
+        app.config['LOGS_DIR_OK'] = os.access(app.config['LOGS_FOLDER'], os.W_OK)
+    except OSError as e:
+        print(f"No se pudo preparar el directorio de logs: {e}")
+        app.config['LOGS_DIR_OK'] = False
+    
     # Configuración del servidor RTMP para HLS
     # Obtener automáticamente la IP de la máquina
     def get_local_ip():
@@ -72,6 +82,8 @@ def create_app():
     
     # Configurar limpieza al cerrar la aplicación
     import atexit
+    from .routes import detener_recolector
     atexit.register(video_processor.stop_workers)
+    atexit.register(detener_recolector)
     
     return app
@@ -25,16 +25,15 @@ def get_transcoding_status(filename):
     
     # Verificar si hay una tarea de transcodificación en curso
     task_info = None
-    for task_id, task in video_processor.active_tasks.items():
-        if task.get('filename') == filename:
-            task_info = {
-                'task_id': task_id,
-                'status': 'processing',
-                'progress': task.get('progress', 0),
-                'started_at': task.get('started_at'),
-                'filename': filename
-            }
-            break
+    tarea = video_processor.find_task(filename, 'processing')
+    if tarea is not None:
+        task_info = {
+            'task_id': tarea.task_id,
+            'status': 'processing',
+            'progress': tarea.progress,
+            'started_at': tarea.start_time,
+            'filename': filename
+        }
     
     # Si no hay tarea en curso, verificar si existe la versión transcodificada
     if not task_info:
@@ -15,7 +15,29 @@ class Canal:
         ('streaming', 'Streaming')
     ]
     
-    def __init__(self, nombre, tipo_contenido, rotacion=0, repeticion='bucle', contenidos=None, id=None, proceso_ffmpeg=None, en_transmision=False):
+    # Marcadores del comando FFmpeg precompilado, sustituidos al iniciar la transmisión
+    FFMPEG_PLAYLIST = '{playlist}'
+    FFMPEG_RTMP = '{rtmp}'
+    # Versión de build_ffmpeg_template: incrementarla al cambiar el comando para que
+    # los comandos guardados con una versión anterior se regeneren al cargarse
+    FFMPEG_TEMPLATE_VERSION = 1
+    
+    # Filtros de video según la rotación configurada
+    FILTROS_ROTACION = {
+        90: 'transpose=1',  # 90° horario
+        180: 'transpose=2,transpose=2',  # 180°
+        270: 'transpose=2'  # 90° antihorario
+    }
+    
+    # Campos persistidos en el archivo (ver to_dict); solo sus cambios marcan el canal como modificado
+    CAMPOS_PERSISTIDOS = frozenset({
+        'id', 'nombre', 'tipo_contenido', 'rotacion', 'repeticion', 'contenidos',
+        'proceso_ffmpeg', 'en_transmision', 'ffmpeg_template', 'ffmpeg_template_version',
+        'fecha_creacion', 'fecha_actualizacion'
+    })
+    
+    def __init__(self, nombre, tipo_contenido, rotacion=0, repeticion='bucle', contenidos=None, id=None, proceso_ffmpeg=None, en_transmision=False, ffmpeg_template=None):
+        self._dirty = set()  # Campos persistidos modificados desde la última carga o guardado
         self.id = id if id is not None else self._generar_id()
         self.nombre = nombre
         self.tipo_contenido = tipo_contenido
@@ -24,6 +46,8 @@ class Canal:
         self.contenidos = contenidos if contenidos is not None else []
         self.proceso_ffmpeg = proceso_ffmpeg  # ID del proceso FFmpeg si está en ejecución
         self.en_transmision = en_transmision  # Estado de la transmisión
+        self.ffmpeg_template = ffmpeg_template  # Comando FFmpeg precompilado (ver build_ffmpeg_template)
+        self.ffmpeg_template_version = self.FFMPEG_TEMPLATE_VERSION if ffmpeg_template else None
         self.fecha_creacion = datetime.now().isoformat()
         self.fecha_actualizacion = self.fecha_creacion
         self._current_playlist_index = 0  # Índice del contenido actual en reproducción
@@ -31,6 +55,12 @@ class Canal:
         self._preloaded_content = None  # Contenido precargado
         self._playback_queue = []  # Cola de reproducción
     
+    def __setattr__(self, nombre, valor):
+        """Registra en _dirty los campos persistidos cuyo valor cambia."""
+        if nombre in self.CAMPOS_PERSISTIDOS and (nombre not in self.__dict__ or self.__dict__[nombre] != valor):
+            self._dirty.add(nombre)
+        object.__setattr__(self, nombre, valor)
+    
     @classmethod
     def _generar_id(cls):
         """Genera un nuevo ID único para el canal."""
@@ -48,6 +78,8 @@ class Canal:
             'contenidos': self.contenidos,
             'proceso_ffmpeg': self.proceso_ffmpeg,
             'en_transmision': self.en_transmision,
+            'ffmpeg_template': self.ffmpeg_template,
+            'ffmpeg_template_version': self.ffmpeg_template_version,
             'fecha_creacion': self.fecha_creacion,
             'fecha_actualizacion': self.fecha_actualizacion
         }
@@ -60,6 +92,12 @@ class Canal:
         proceso_ffmpeg = data.get('proceso_ffmpeg')
         contenidos = data.get('contenidos', [])
         
+        # Un comando guardado por otra versión de build_ffmpeg_template (o sin versión)
+        # se descarta y se regenera con la configuración de codificación actual
+        ffmpeg_template = None
+        if data.get('ffmpeg_template_version') == cls.FFMPEG_TEMPLATE_VERSION:
+            ffmpeg_template = data.get('ffmpeg_template')
+        
         canal = cls(
             id=data['id'],
             nombre=data['nombre'],
@@ -68,7 +106,8 @@ class Canal:
             repeticion=data['repeticion'],
             en_transmision=en_transmision,
             contenidos=contenidos,
-            proceso_ffmpeg=proceso_ffmpeg
+            proceso_ffmpeg=proceso_ffmpeg,
+            ffmpeg_template=ffmpeg_template
         )
         
         # Asegurarse de que los atributos estén establecidos
@@ -79,8 +118,64 @@ class Canal:
             
         canal.fecha_creacion = data.get('fecha_creacion', datetime.now().isoformat())
         canal.fecha_actualizacion = data.get('fecha_actualizacion', datetime.now().isoformat())
+        
+        # Recién cargado: coincide con lo almacenado
+        canal._dirty.clear()
         return canal
     
+    def build_ffmpeg_template(self):
+        """Precompila el comando FFmpeg del canal a partir de su configuración.
+        
+        Solo la playlist y la URL RTMP varían entre inicios, así que se dejan como
+        marcadores (FFMPEG_PLAYLIST / FFMPEG_RTMP). Debe llamarse al editar el canal.
+        
+        Returns:
+            list: Argumentos del comando con marcadores
+        """
+        cmd = [
+            'ffmpeg',
+            '-re',  # Leer entrada a velocidad nativa
+            '-stream_loop', '-1' if self.repeticion == 'bucle' else '0',  # Bucle infinito si está habilitado
+            '-f', 'concat',  # Usar concatenación
+            '-safe', '0',  # Permitir rutas absolutas en la lista
+            '-i', self.FFMPEG_PLAYLIST  # Archivo de lista de reproducción
+        ]
+        
+        # Aplicar rotación según la configuración del canal
+        filtro_rotacion = self.FILTROS_ROTACION.get(self.rotacion)
+        if filtro_rotacion:
+            cmd.extend(['-vf', filtro_rotacion])
+        
+        # Configuración de codificación optimizada
+        cmd.extend([
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',  # Balance entre velocidad y calidad
+            '-tune', 'zerolatency',  # Optimización para streaming en tiempo real
+            '-b:v', '5000k',
+            '-maxrate', '5000k',
+            '-bufsize', '10000k',  # 2x el bitrate
+            '-g', '60',  # Keyframe cada 2 segundos (a 30fps)
+            '-keyint_min', '60',  # Mínimo de frames entre keyframes
+            '-sc_threshold', '0',  # Deshabilitar detección de escenas
+            '-pix_fmt', 'yuv420p',  # Formato de píxel compatible
+            '-c:a', 'aac',  # Códec de audio
+            '-b:a', '192k',
+            '-ar', '44100',  # Frecuencia de muestreo de audio
+            '-ac', '2',  # Audio estéreo
+            '-f', 'flv',  # Formato de salida
+            self.FFMPEG_RTMP
+        ])
+        
+        self.ffmpeg_template = cmd
+        self.ffmpeg_template_version = self.FFMPEG_TEMPLATE_VERSION
+        return cmd
+    
+    def build_ffmpeg_cmd(self, playlist_path, rtmp_url):
+        """Devuelve el comando FFmpeg final sustituyendo los marcadores del comando precompilado."""
+        template = self.ffmpeg_template or self.build_ffmpeg_template()
+        sustituciones = {self.FFMPEG_PLAYLIST: playlist_path, self.FFMPEG_RTMP: rtmp_url}
+        return [sustituciones.get(arg, arg) for arg in template]
+    
     @classmethod
     def guardar_todos(cls, canales):
         """Guarda todos los canales en el archivo de almacenamiento."""
@@ -101,6 +196,9 @@ class Canal:
                 os.replace(temp_file, cls._archivo_almacenamiento)
             else:
                 os.rename(temp_file, cls._archivo_almacenamiento)
+            
+            for canal in canales:
+                canal._dirty.clear()
                 
         except Exception as e:
             print(f"Error al guardar canales: {e}")
@@ -149,7 +247,13 @@ class Canal:
     
     @classmethod
     def guardar(cls, canal):
-        """Guarda un canal, actualizándolo si ya existe o creándolo si no."""
+        """Guarda un canal, actualizándolo si ya existe o creándolo si no.
+        
+        No reescribe el archivo si ningún campo persistido del canal ha cambiado.
+        """
+        if not canal._dirty:
+            return
+        
         canales = cls.cargar_todos()
         
         # Buscar si el canal ya existe
@@ -24,6 +24,10 @@ main_bp = Blueprint('main', __name__)
 # Variable global para almacenar el hash de la lista M3U
 m3u_hash = None
 
+# Caché de la lista M3U generada (ver obtener_m3u)
+_m3u_cache = {'clave': None, 'contenido': None, 'hash': None}
+_m3u_cache_lock = threading.Lock()
+
 def obtener_archivos_multimedia(include_processing=False):
     """Obtiene la lista de archivos multimedia subidos con su estado de transcodificación.
     Prioriza los archivos transcodificados cuando están disponibles.
@@ -84,10 +88,8 @@ def obtener_archivos_multimedia(include_processing=False):
             ext = ext[1:].lower() if ext else ''
             
             # Verificar si el archivo está siendo procesado
-            is_processing = any(
-                task.get('filename') == filename and task.get('status') == 'processing'
-                for task in video_processor.active_tasks.values()
-            )
+            tarea = video_processor.find_task(filename, 'processing')
+            is_processing = tarea is not None
             
             # Si no queremos incluir archivos en proceso y este lo está, lo saltamos
             if not include_processing and is_processing:
@@ -98,11 +100,7 @@ def obtener_archivos_multimedia(include_processing=False):
             progress = 0
             
             if is_processing:
-                # Buscar el progreso actual en las tareas activas
-                for task in video_processor.active_tasks.values():
-                    if task.get('filename') == filename:
-                        progress = task.get('progress', 0)
-                        break
+                progress = tarea.progress
             
             archivos.append({
                 'name': filename,
@@ -132,17 +130,9 @@ def get_transcoding_status(filename):
         if not os.path.exists(original_path):
             return jsonify({'success': False, 'error': 'Archivo no encontrado'}), 404
 
-        # Buscar en todas las listas de tareas del procesador
-        with video_processor.lock:
-            all_tasks = list(video_processor.active_tasks.items()) + \
-                        list(video_processor.queued_tasks.items()) + \
-                        list(video_processor.completed_tasks.items())
-
-        task_info = None
-        for task_id, task in all_tasks:
-            if task.get('filename') == filename:
-                task_info = task
-                break
+        # Buscar la tarea más reciente del archivo en el procesador
+        tarea = video_processor.find_task(filename)
+        task_info = tarea.to_dict() if tarea is not None else None
 
         # Construir respuesta basada en la tarea encontrada
         if task_info:
@@ -215,16 +205,6 @@ def iniciar_transcodificacion(original_path, filename):
             logger.error(f"No se pudo iniciar la transcodificación de {filename}: {output_path}")
             return None
         
-        # Actualizar información de la tarea
-        with video_processor.lock:
-            if task_id in video_processor.active_tasks:
-                video_processor.active_tasks[task_id].update({
-                    'filename': filename,
-                    'original_path': original_path,
-                    'output_path': output_path,
-                    'started_at': datetime.utcnow()
-                })
-        
         logger.info(f"Tarea de transcodificación iniciada: {filename} (ID: {task_id})")
         return task_id
         
@@ -353,10 +333,10 @@ def gestion_contenido():
                         task_id = iniciar_transcodificacion(original_path, filename)
                         if task_id:
                             file_info['task_id'] = task_id
-                            # Obtener el progreso inicial de la tarea activa
-                            with video_processor.lock:
-                                if task_id in video_processor.active_tasks:
-                                    file_info['progress'] = video_processor.active_tasks[task_id].get('progress', 0)
+                            # Obtener el progreso inicial de la tarea
+                            estado = video_processor.get_task_status(task_id)
+                            if estado:
+                                file_info['progress'] = estado.get('progress', 0)
                     
                     uploaded_files.append(file_info)
                 except Exception as e:
@@ -475,6 +455,9 @@ def guardar_canal():
             contenidos=contenidos
         )
     
+    # Precompilar el comando FFmpeg con la configuración actual del canal
+    canal.build_ffmpeg_template()
+    
     # Guardar el canal
     try:
         Canal.guardar(canal)
@@ -658,16 +641,9 @@ def eliminar_archivo():
                         errors.append(f'Error al eliminar versión transcodificada de {filename}: {str(e)}')
                 
                 # Eliminar tareas relacionadas si existen
-                with video_processor.lock:
-                    # Buscar tareas que coincidan con el nombre del archivo
-                    tasks_to_remove = []
-                    for task_id, task in video_processor.active_tasks.items():
-                        if task.get('filename') == filename:
-                            tasks_to_remove.append(task_id)
-                    
-                    # Eliminar las tareas encontradas
-                    for task_id in tasks_to_remove:
-                        video_processor.cancel_task(task_id)
+                tarea = video_processor.find_task(filename, 'processing')
+                if tarea is not None:
+                    video_processor.cancel_task(tarea.task_id)
             
             except Exception as e:
                 errors.append(f'Error al procesar {filename}: {str(e)}')
@@ -686,6 +662,96 @@ def eliminar_archivo():
         flash(f'Error inesperado: {str(e)}', 'error')
         return redirect(url_for('main.gestion_contenido'))
 
+# Procesos FFmpeg de transmisión vigilados por un único hilo recolector:
+# pid -> (Popen, canal_id). Evita un hilo bloqueado en wait() por canal.
+_procesos_vigilados = {}
+_procesos_lock = threading.Lock()
+_recolector = None
+_recolector_stop = threading.Event()
+
+def _liberar_canal(canal_id, pid):
+    """Marca el canal como detenido si su proceso FFmpeg registrado sigue siendo `pid`."""
+    try:
+        canal = Canal.obtener_por_id(canal_id)
+        if canal and isinstance(canal.proceso_ffmpeg, dict) and canal.proceso_ffmpeg.get('pid') == pid:
+            canal.en_transmision = False
+            canal.proceso_ffmpeg = None
+            Canal.guardar(canal)
+    except Exception as e:
+        print(f"Error en limpieza del canal {canal_id}: {e}")
+
+def _bucle_recolector():
+    """Recoge los procesos FFmpeg terminados y libera sus canales."""
+    while not _recolector_stop.wait(0.5):
+        # poll() hace waitpid(pid, WNOHANG) solo sobre nuestros procesos, sin robar
+        # el estado de salida de otros subprocesos (p. ej. los del video_processor)
+        with _procesos_lock:
+            terminados = [(pid, proceso.returncode, canal_id)
+                          for pid, (proceso, canal_id) in _procesos_vigilados.items()
+                          if proceso.poll() is not None]
+            for pid, _, _ in terminados:
+                del _procesos_vigilados[pid]
+        
+        for pid, returncode, canal_id in terminados:
+            print(f"Proceso FFmpeg {pid} del canal {canal_id} terminado con código {returncode}")
+            _liberar_canal(canal_id, pid)
+
+def lanzar_ffmpeg(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL):
+    """Inicia un proceso FFmpeg de transmisión en su propia sesión y grupo de procesos.
+
+    start_new_session=True equivale a llamar os.setsid en el hijo, pero sin ejecutar
+    código Python tras el fork, lo que permite a subprocess usar posix_spawn/vfork.
+
+    Args:
+        cmd: Lista de argumentos del comando FFmpeg
+        stdout, stderr: Archivos abiertos en binario o subprocess.DEVNULL
+
+    Returns:
+        subprocess.Popen: El proceso iniciado
+    """
+    return subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=stdout,
+        stderr=stderr,
+        start_new_session=True,
+        close_fds=True
+    )
+
+def vigilar_proceso_ffmpeg(proceso, canal_id):
+    """Registra un proceso FFmpeg en el recolector, iniciándolo si es necesario."""
+    global _recolector
+    with _procesos_lock:
+        _procesos_vigilados[proceso.pid] = (proceso, canal_id)
+        if _recolector is None or not _recolector.is_alive():
+            _recolector_stop.clear()
+            _recolector = threading.Thread(target=_bucle_recolector, daemon=True, name='FFmpegReaper')
+            _recolector.start()
+
+def esperar_proceso_ffmpeg(pid, timeout=None):
+    """Espera al proceso FFmpeg vigilado con ese PID y devuelve su código de salida.
+
+    Solo espera al Popen registrado, nunca con waitpid(-1), para no robar el estado
+    de salida de otros subprocesos. Devuelve None si el PID no está vigilado o no
+    termina a tiempo; en ese caso el recolector lo recogerá más tarde.
+    """
+    with _procesos_lock:
+        vigilado = _procesos_vigilados.get(pid)
+    if vigilado is None:
+        return None
+    try:
+        return vigilado[0].wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+
+def detener_recolector():
+    """Detiene el hilo recolector de procesos FFmpeg."""
+    global _recolector
+    _recolector_stop.set()
+    if _recolector is not None:
+        _recolector.join(timeout=2)
+        _recolector = None
+
 @main_bp.route('/canales/transmitir/<int:canal_id>', methods=['GET', 'POST'])
 def transmitir_canal(canal_id):
     """Inicia o detiene la transmisión de un canal."""
@@ -853,24 +919,10 @@ def transmitir_canal(canal_id):
                 # Esperar un poco más
                 time.sleep(1)
             
-            # 6. Limpiar procesos zombie
-            print("[DEBUG] Limpiando procesos zombie...")
-            try:
-                while True:
-                    try:
-                        # waitpid con WNOHANG para no bloquear
-                        pid_done, status = os.waitpid(-1, os.WNOHANG)
-                        if pid_done == 0:  # No hay más procesos hijos
-                            break
-                        print(f"[DEBUG] Proceso hijo {pid_done} terminado con estado {status}")
-                    except ChildProcessError:
-                        print("[DEBUG] No hay más procesos hijos para esperar")
-                        break
-                    except Exception as e:
-                        print(f"[ERROR] Error al esperar procesos hijos: {e}")
-                        break
-            except Exception as e:
-                print(f"[ERROR] Error en la limpieza de procesos zombie: {e}")
+            # 6. Recoger el proceso principal para que no quede zombie
+            returncode = esperar_proceso_ffmpeg(pid, timeout=1)
+            if returncode is not None:
+                print(f"[DEBUG] Proceso {pid} recogido con código {returncode}")
             
             # 7. Verificación final
             try:
@@ -1028,11 +1080,7 @@ def transmitir_canal(canal_id):
                         # Si es un archivo de video y no está transcodificado, verificar si hay una tarea de transcodificación en curso
                         if not es_transcodificado and filename.lower().endswith(('.mp4', '.mov', '.avi', '.mkv')):
                             # Verificar si hay una tarea de transcodificación pendiente
-                            esta_procesando = any(
-                                task_id in video_processor.active_tasks and 
-                                video_processor.active_tasks[task_id].get('filename') == filename
-                                for task_id in video_processor.active_tasks
-                            )
+                            esta_procesando = video_processor.find_task(filename, 'processing') is not None
                             
                             if esta_procesando:
                                 print(f"[INFO] El archivo {filename} está siendo transcodificado. Se usará temporalmente la versión original.")
@@ -1071,66 +1119,17 @@ def transmitir_canal(canal_id):
             print(f"Iniciando transmisión en: {rtmp_url}")
             print(f"Asegúrate de que el servidor RTMP en {rtmp_server} esté en ejecución y accesible")
             
-            # Configurar filtros de video (incluyendo rotación)
-            filter_complex = []
-            
-            # Unir todos los filtros con comas
-            vf = ','.join(filter_complex) if filter_complex else ''
-            
-            # Construir comando FFmpeg con parámetros optimizados
-            ffmpeg_cmd = ['ffmpeg']
-            
-            # Opciones de entrada
-            ffmpeg_cmd.extend([
-                '-re',  # Leer entrada a velocidad nativa
-                '-stream_loop', '-1' if canal.repeticion == 'bucle' else '0',  # Bucle infinito si está habilitado
-                '-f', 'concat',  # Usar concatenación
-                '-safe', '0',  # Permitir rutas absolutas en la lista
-                '-i', playlist_file  # Archivo de lista de reproducción
-            ])
-            
-            # Configuración de video
-            video_filters = []
-            
-            # Aplicar rotación según la configuración del canal
-            if hasattr(canal, 'rotacion') and canal.rotacion is not None:
-                if canal.rotacion == 90:
-                    video_filters.append('transpose=1')  # 90° horario
-                elif canal.rotacion == 180:
-                    video_filters.append('transpose=2,transpose=2')  # 180°
-                elif canal.rotacion == 270:
-                    video_filters.append('transpose=2')  # 90° antihorario
-            
-            # Añadir filtros de video si existen
-            if video_filters:
-                ffmpeg_cmd.extend(['-vf', ','.join(video_filters)])
-            
-            # Configuración de codificación optimizada
-            ffmpeg_cmd.extend([
-                '-c:v', 'libx264',
-                '-preset', 'veryfast',  # Balance entre velocidad y calidad
-                '-tune', 'zerolatency',  # Optimización para streaming en tiempo real
-                '-b:v', '5000k',  # Aumentado de 3000k a 5000k para mejor calidad
-                '-maxrate', '5000k',  # Aumentado el bitrate máximo
-                '-bufsize', '10000k',  # Aumentado el buffer (2x el bitrate)
-                '-g', '60',  # Keyframe cada 2 segundos (a 30fps)
-                '-keyint_min', '60',  # Mínimo de frames entre keyframes
-                '-sc_threshold', '0',  # Deshabilitar detección de escenas
-                '-pix_fmt', 'yuv420p',  # Formato de píxel compatible
-                '-c:a', 'aac',  # Códec de audio
-                '-b:a', '192k',  # Aumentado de 128k a 192k para mejor calidad de audio
-                '-ar', '44100',  # Frecuencia de muestreo de audio
-                '-ac', '2',  # Audio estéreo
-                '-f', 'flv',  # Formato de salida
-                rtmp_url
-            ])
+            # Comando precompilado al guardar el canal; solo se sustituyen playlist y URL RTMP
+            ffmpeg_cmd = canal.build_ffmpeg_cmd(playlist_file, rtmp_url)
             
             # Mostrar el comando completo para depuración
             print("Comando FFmpeg:", ' '.join(ffmpeg_cmd))
             
             # Crear directorio de logs si no existe
-            log_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'logs')
-            os.makedirs(log_dir, exist_ok=True)
+            # El directorio se crea y se verifica una sola vez en create_app()
+            log_dir = current_app.config['LOGS_FOLDER']
+            if not current_app.config.get('LOGS_DIR_OK', False):
+                raise Exception(f'No se puede escribir en el directorio de logs: {log_dir}')
             
             # Archivos de log para stdout y stderr
             log_file = os.path.join(log_dir, f'ffmpeg_{canal_id}.log')
@@ -1141,35 +1140,16 @@ def transmitir_canal(canal_id):
             pgid = None
             
             try:
-                # Abrir archivos de log
-                f_log = open(log_file, 'a')
-                f_err = open(error_file, 'a')
+                # Abrir archivos de log en binario y sin buffer: FFmpeg escribe
+                # directamente en los descriptores, Python no necesita envoltorios de texto
+                f_log = open(log_file, 'ab', buffering=0)
+                f_err = open(error_file, 'ab', buffering=0)
                 
                 try:
-                    # Configuración para el proceso
-                    process_args = {
-                        'stdin': subprocess.DEVNULL,  # No necesitamos stdin
-                        'stdout': f_log,
-                        'stderr': f_err,
-                        'start_new_session': True,
-                        'close_fds': True,  # Cerrar todos los descriptores de archivo heredados
-                        'bufsize': 0,  # Sin buffer
-                    }
-                    
                     # Iniciar el proceso FFmpeg
                     try:
-                        # Primero intentamos con preexec_fn si está disponible
-                        try:
-                            process_args['preexec_fn'] = os.setsid
-                            proceso = subprocess.Popen(ffmpeg_cmd, **process_args)
-                            print("Proceso FFmpeg iniciado con nuevo grupo de sesión")
-                        except Exception as e:
-                            print(f"No se pudo crear nuevo grupo de sesión: {e}")
-                            print("Intentando sin preexec_fn...")
-                            if 'preexec_fn' in process_args:
-                                del process_args['preexec_fn']
-                            proceso = subprocess.Popen(ffmpeg_cmd, **process_args)
-                            print("Proceso FFmpeg iniciado sin nuevo grupo de sesión")
+                        proceso = lanzar_ffmpeg(ffmpeg_cmd, stdout=f_log, stderr=f_err)
+                        print("Proceso FFmpeg iniciado con nuevo grupo de sesión")
                         
                         # Pequeña pausa para permitir que FFmpeg inicie
                         time.sleep(1)
@@ -1177,7 +1157,6 @@ def transmitir_canal(canal_id):
                         # Verificar si el proceso sigue activo
                         if proceso.poll() is not None:
                             # Leer el error si hay alguno
-                            f_err.flush()
                             with open(error_file, 'r') as f:
                                 error_output = f.read()
                             raise Exception(f"El proceso FFmpeg terminó inesperadamente con código {proceso.returncode}. Error: {error_output[-1000:]}")
@@ -1211,8 +1190,6 @@ def transmitir_canal(canal_id):
                         
                 finally:
                     # Cerrar archivos de log
-                    f_log.flush()
-                    f_err.flush()
                     f_log.close()
                     f_err.close()
                     
@@ -1231,6 +1208,9 @@ def transmitir_canal(canal_id):
             canal.ultima_transmision = datetime.now()
             Canal.guardar(canal)
             
+            # Liberar el canal automáticamente si FFmpeg termina por su cuenta
+            vigilar_proceso_ffmpeg(proceso, canal.id)
+            
             # Actualizar la lista M3U
             actualizar_m3u()
             
@@ -1434,12 +1414,7 @@ def transmitir_canal(canal_id):
         
         try:
             # Iniciar el proceso FFmpeg
-            proceso = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                start_new_session=True
-            )
+            proceso = lanzar_ffmpeg(ffmpeg_cmd)
             
             # Guardar información del proceso
             canal.proceso_ffmpeg = {
@@ -1610,8 +1585,7 @@ def transmitir_canal(canal_id):
             return redirect(url_for('main.gestion_canales'))
         
         # Configurar archivos de log
-        logs_dir = os.path.join(current_app.root_path, 'logs')
-        os.makedirs(logs_dir, exist_ok=True)
+        logs_dir = current_app.config['LOGS_FOLDER']
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         log_file = os.path.join(logs_dir, f'ffmpeg_{canal.id}_{timestamp}.log')
         err_file = os.path.join(logs_dir, f'ffmpeg_{canal.id}_{timestamp}.err')
@@ -1765,12 +1739,8 @@ def transmitir_canal(canal_id):
             
             try:
                 # Iniciar el proceso FFmpeg
-                with open(log_file, 'w') as log_f, open(err_file, 'w') as err_f:
-                    process = subprocess.Popen(
-                        cmd,
-                        stdout=log_f,
-                        stderr=err_f
-                    )
+                with open(log_file, 'wb', buffering=0) as log_f, open(err_file, 'wb', buffering=0) as err_f:
+                    process = lanzar_ffmpeg(cmd, stdout=log_f, stderr=err_f)
                     
                     # Configurar manejo de señales simple sin verificación de hilo
                     def handle_signal(signum, frame):
@@ -1813,25 +1783,8 @@ def transmitir_canal(canal_id):
                     canal.en_transmision = True
                     Canal.guardar(canal)
                     
-                    # Iniciar un hilo para monitorear el proceso
-                    def monitor_process(proc, pid, log_path):
-                        proc.wait()
-                        print(f"Proceso FFmpeg {pid} terminado con código {proc.returncode}")
-                        # Leer los logs para depuración
-                        try:
-                            with open(log_path, 'r') as f:
-                                logs = f.read()
-                                print(f"Últimas líneas del log ({pid}): {logs[-500:]}")
-                        except Exception as e:
-                            print(f"No se pudo leer el log del proceso {pid}: {e}")
-                    
-                    import threading
-                    monitor_thread = threading.Thread(
-                        target=monitor_process,
-                        args=(process, process.pid, err_file),
-                        daemon=True
-                    )
-                    monitor_thread.start()
+                    # Monitorear el proceso desde el hilo recolector compartido
+                    vigilar_proceso_ffmpeg(process, canal.id)
                     
                     print(f"Transmisión iniciada con PID {process.pid} (PGID: {os.getpgid(process.pid) if hasattr(os, 'getpgid') else 'N/A'})")
                     flash('Transmisión iniciada correctamente', 'success')
@@ -2009,19 +1962,14 @@ def transmitir_canal(canal_id):
             return redirect(url_for('main.gestion_canales'))
         
         # Configurar archivos de log con identificadores únicos
-        logs_dir = os.path.join(current_app.root_path, 'logs')
-        os.makedirs(logs_dir, exist_ok=True)
+        logs_dir = current_app.config['LOGS_FOLDER']
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         log_file = os.path.join(logs_dir, f'ffmpeg_{canal.id}_{timestamp}.log')
         err_file = os.path.join(logs_dir, f'ffmpeg_{canal.id}_{timestamp}.err')
         
-        # Verificar permisos de escritura en el directorio de logs
-        try:
-            with open(os.path.join(logs_dir, 'test_permissions'), 'w') as f:
-                f.write('test')
-            os.remove(os.path.join(logs_dir, 'test_permissions'))
-        except Exception as e:
-            error_msg = f'Error de permisos en el directorio de logs: {str(e)}'
+        # Los permisos del directorio de logs se verifican una sola vez en create_app()
+        if not current_app.config.get('LOGS_DIR_OK', False):
+            error_msg = f'Error de permisos en el directorio de logs: {logs_dir}'
             print(error_msg)
             flash(error_msg, 'error')
             return redirect(url_for('main.gestion_canales'))
@@ -2144,25 +2092,13 @@ def transmitir_canal(canal_id):
                         if hasattr(test_e, 'stderr') and test_e.stderr:
                             print(f"Salida de error: {test_e.stderr}")
                     
-                    # Crear el directorio de logs si no existe
-                    os.makedirs(logs_dir, exist_ok=True)
-                    
                     # Abrir los archivos de log en modo append para no perder información
-                    with open(log_file, 'a') as log_f, open(err_file, 'a') as err_f:
-                        log_f.write(f"\n\n=== Iniciando transmisión a las {datetime.now().isoformat()} ===\n")
-                        log_f.write(f"Comando: {' '.join(cmd)}\n")
-                        log_f.flush()
+                    with open(log_file, 'ab', buffering=0) as log_f, open(err_file, 'ab', buffering=0) as err_f:
+                        log_f.write(f"\n\n=== Iniciando transmisión a las {datetime.now().isoformat()} ===\n"
+                                    f"Comando: {' '.join(cmd)}\n".encode('utf-8'))
                         
                         # Ejecutar FFmpeg con Popen
-                        proceso = subprocess.Popen(
-                            cmd,
-                            stdout=log_f,
-                            stderr=err_f,
-                            start_new_session=True,
-                            text=True,
-                            bufsize=1,
-                            universal_newlines=True
-                        )
+                        proceso = lanzar_ffmpeg(cmd, stdout=log_f, stderr=err_f)
                         
                         # Esperar un momento para ver si el proceso falla inmediatamente
                         import time
@@ -2201,7 +2137,7 @@ def transmitir_canal(canal_id):
                         try:
                             # Guardar el canal y actualizar el hash M3U
                             if Canal.guardar(canal):
-                                m3u_hash = get_m3u_hash()
+                                _, m3u_hash = obtener_m3u()
                                 print(f"Estado del canal actualizado. Nuevo hash M3U: {m3u_hash}")
                             else:
                                 print("Advertencia: No se pudo guardar el estado del canal")
@@ -2272,42 +2208,24 @@ def transmitir_canal(canal_id):
                 flash(error_msg, 'error')
                 return redirect(url_for('main.gestion_canales'))
             
-            # Función para limpieza cuando el proceso termine
-            def cleanup(pid):
-                try:
-                    canal_cleanup = Canal.obtener_por_id(canal_id)
-                    if canal_cleanup and canal_cleanup.proceso_ffmpeg == pid:
-                        canal_cleanup.en_transmision = False
-                        canal_cleanup.proceso_ffmpeg = None
-                        Canal.guardar(canal_cleanup)
-                except Exception as e:
-                    print(f"Error en limpieza: {e}")
-            
-            # Usar un hilo para esperar el proceso sin bloquear
+            # Registrar el proceso en el hilo recolector compartido
             try:
-                import threading
-                thread = threading.Thread(
-                    target=lambda p, pid: (p.wait(), cleanup(pid)),
-                    args=(proceso, proceso.pid)
-                )
-                thread.daemon = True  # El hilo no evitará que el programa termine
-                thread.start()
+                vigilar_proceso_ffmpeg(proceso, canal_id)
                 
                 # Actualizar el hash M3U cuando se inicia una transmisión
-                m3u_hash = get_m3u_hash()
+                _, m3u_hash = obtener_m3u()
                 
                 flash('Transmisión iniciada correctamente', 'success')
                 return redirect(url_for('main.gestion_canales'))
                 
             except Exception as e:
                 import traceback
-                error_msg = f'Error al iniciar el hilo de limpieza: {str(e)}\n\n{traceback.format_exc()}'
+                error_msg = f'Error al registrar el proceso en el recolector: {str(e)}\n\n{traceback.format_exc()}'
                 print(error_msg)
                 
                 # Intentar escribir en el archivo de log si es posible
                 try:
-                    logs_dir = os.path.join(current_app.root_path, 'logs')
-                    os.makedirs(logs_dir, exist_ok=True)
+                    logs_dir = current_app.config['LOGS_FOLDER']
                     with open(os.path.join(logs_dir, 'error.log'), 'a') as f:
                         f.write(f"[{datetime.now().isoformat()}] {error_msg}\n\n")
                 except Exception as log_error:
@@ -2323,83 +2241,94 @@ def transmitir_canal(canal_id):
             return redirect(url_for('main.gestion_canales'))
 
 def generate_m3u():
-    """Genera el contenido M3U de los streams activos"""
+    """Genera el contenido M3U de los streams activos.
+    
+    Returns:
+        tuple: (contenido, hash) donde el hash se calcula de forma incremental
+        con blake2b sobre cada entrada mientras se construye la lista.
+    """
     try:
-        canales = Canal.cargar_todos() or []
-        m3u_content = "#EXTM3U\n"
+        # Canal.cargar_todos() siempre devuelve instancias de Canal
+        canales = Canal.cargar_todos()
+        cabecera = "#EXTM3U\n"
+        partes = [cabecera]
+        resumen = hashlib.blake2b(cabecera.encode('utf-8'), digest_size=16)
+        host = request.host.split(':')[0]  # Remover el puerto si existe
         
         for canal in canales:
-            # Asegurarse de que el canal sea un diccionario
-            if not isinstance(canal, dict):
-                canal = canal.__dict__ if hasattr(canal, '__dict__') else {}
-            
             # Verificar si el canal está transmitiendo
-            if canal.get('en_transmision') == True or canal.get('estado') == 'transmitiendo':
+            if canal.en_transmision:
                 # Obtener el ID y nombre del canal de manera segura
-                canal_id = canal.get('id') or ''
-                nombre = canal.get('nombre', 'Sin nombre')
+                canal_id = canal.id or ''
+                nombre = canal.nombre or 'Sin nombre'
                 
                 # Construir la URL del stream con el formato correcto: /hls/NOMBRE.m3u8
-                host = request.host.split(':')[0]  # Remover el puerto si existe
                 nombre_archivo = f"{nombre.lower().replace(' ', '_')}.m3u8"
                 
                 # Usar siempre HTTP para la URL del stream ya que Nginx manejará el SSL
                 stream_url = f"http://{host}/hls/{nombre_archivo}"
                 
                 # Agregar la entrada al M3U
-                m3u_content += f"#EXTINF:-1 tvg-id=\"{canal_id}\" tvg-name=\"{nombre}\" group-title=\"Signally\",{nombre}\n"
-                m3u_content += f"{stream_url}\n"
+                entrada = (f"#EXTINF:-1 tvg-id=\"{canal_id}\" tvg-name=\"{nombre}\" group-title=\"Signally\",{nombre}\n"
+                           f"{stream_url}\n")
+                partes.append(entrada)
+                resumen.update(entrada.encode('utf-8'))
         
-        return m3u_content
+        return ''.join(partes), resumen.hexdigest()
     except Exception as e:
         import traceback
         print(f"Error al generar M3U: {str(e)}")
         print(traceback.format_exc())
-        return "#EXTM3U\n# Error al generar la lista de reproducción"
+        m3u_content = "#EXTM3U\n# Error al generar la lista de reproducción"
+        return m3u_content, hashlib.blake2b(m3u_content.encode('utf-8'), digest_size=16).hexdigest()
+
+def _clave_m3u():
+    """Clave de la caché M3U: host solicitado y firma (mtime, tamaño) de canales.json."""
+    try:
+        st = os.stat(Canal._archivo_almacenamiento)
+        firma = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        firma = None
+    return request.host.split(':')[0], firma
 
-def get_m3u_hash():
-    """Calcula el hash del contenido M3U actual"""
-    m3u_content = generate_m3u()
-    return hashlib.md5(m3u_content.encode('utf-8')).hexdigest()
+def obtener_m3u():
+    """Devuelve (contenido, hash) de la lista M3U, regenerándola solo si cambiaron los canales."""
+    clave = _clave_m3u()
+    with _m3u_cache_lock:
+        if _m3u_cache['clave'] != clave:
+            _m3u_cache['contenido'], _m3u_cache['hash'] = generate_m3u()
+            _m3u_cache['clave'] = clave
+        return _m3u_cache['contenido'], _m3u_cache['hash']
+
+# Respuesta pre-serializada para el caso habitual (sin cambios en la lista M3U)
+_M3U_SIN_CAMBIOS = b'{"success":true,"needs_update":false}'
 
 @main_bp.route('/api/check_m3u_update')
 def check_m3u_update():
     """Verifica si hay cambios en la lista M3U"""
     global m3u_hash
     try:
-        current_hash = get_m3u_hash()
+        _, current_hash = obtener_m3u()
         
-        print(f"\n=== check_m3u_update ===")
-        print(f"m3u_hash actual: {m3u_hash}")
-        print(f"current_hash: {current_hash}")
-        print(f"¿Necesita actualización?: {m3u_hash != current_hash}")
+        # Camino rápido: sin cambios, sin construir ni serializar un diccionario
+        if current_hash == m3u_hash:
+            return Response(_M3U_SIN_CAMBIOS, mimetype='application/json')
         
         # Si no hay hash guardado, actualizamos con el actual
-        if m3u_hash is None:
-            print("No había hash guardado, actualizando...")
-            m3u_hash = current_hash
-        
-        needs_update = m3u_hash != current_hash
-        
-        # Si hay una diferencia, actualizamos el hash guardado
+        needs_update = m3u_hash is not None
         if needs_update:
-            print("Se detectó un cambio en la lista M3U")
-            m3u_hash = current_hash
+            logger.debug("Se detectó un cambio en la lista M3U: %s -> %s", m3u_hash, current_hash)
+        m3u_hash = current_hash
         
-        response = {
+        return jsonify({
             'success': True,
             'needs_update': needs_update,
             'current_hash': current_hash,
             'stored_hash': m3u_hash
-        }
-        
-        print(f"Respuesta enviada: {response}")
-        return jsonify(response)
+        })
         
     except Exception as e:
-        print(f"Error en check_m3u_update: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
+        logger.error(f"Error en check_m3u_update: {str(e)}", exc_info=True)
         return jsonify({
             'success': False,
             'error': str(e),
@@ -2408,18 +2337,19 @@ def check_m3u_update():
 
 @main_bp.route('/dynamic_channels.m3u')
 def get_m3u_playlist():
-    """Sirve la lista M3U actual"""
-    m3u_content = generate_m3u()
-    return Response(
+    """Sirve la lista M3U actual (responde 304 si el cliente ya tiene la versión vigente)"""
+    m3u_content, m3u_etag = obtener_m3u()
+    response = Response(
         m3u_content,
         mimetype='audio/x-mpegurl',
         headers={
             'Content-Disposition': 'attachment; filename=dynamic_channels.m3u',
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'Expires': '0'
+            # no-cache (sin no-store) para que el cliente revalide con If-None-Match
+            'Cache-Control': 'no-cache'
         }
     )
+    response.set_etag(m3u_etag)
+    return response.make_conditional(request)
 
 @main_bp.route('/actualizar_m3u', methods=['POST'])
 def actualizar_m3u():
@@ -2427,7 +2357,7 @@ def actualizar_m3u():
     global m3u_hash
     try:
         old_hash = m3u_hash
-        m3u_hash = get_m3u_hash()
+        _, m3u_hash = obtener_m3u()
         print(f"\n=== actualizar_m3u ===")
         print(f"Hash anterior: {old_hash}")
         print(f"Nuevo hash: {m3u_hash}")
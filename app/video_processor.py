@@ -1,9 +1,16 @@
 import os
+import signal
+import json
+import functools
+import itertools
 import subprocess
+import tempfile
+import shutil
 import logging
 import time
+from collections import deque
 from queue import Queue, Empty
-from threading import Thread, Lock
+from threading import Thread, Lock, local
 from datetime import datetime
 
 # Configuración de logging
@@ -11,7 +18,51 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Prioridad (nice) de los procesos FFmpeg de transcodificación, para no competir con la web
+NICE_TRANSCODIFICACION = 5
+
+# CPUs asignadas al worker del hilo actual (None = sin restricción)
+_hilo = local()
+
+def _senal_grupo(proceso, sig):
+    try:
+        os.killpg(proceso.pid, sig)
+    except ProcessLookupError:
+        pass
+
+class ProcesadorDetenido(RuntimeError):
+    """No se puede lanzar FFmpeg porque los workers se están deteniendo."""
+
+class TaskRecord:
+    """Estado de una tarea del procesador de video.
+    
+    Cada registro solo lo modifica el worker que procesa la tarea; los lectores
+    obtienen una copia con to_dict() sin necesidad de locks.
+    """
+    __slots__ = ('task_id', 'status', 'filename', 'input_path', 'output_path', 'progress',
+                 'submit_time', 'start_time', 'end_time', 'result', 'error')
+    
+    def __init__(self, task_id, filename=None, input_path=None, output_path=None):
+        self.task_id = task_id
+        self.status = 'queued'
+        self.filename = filename
+        self.input_path = input_path
+        self.output_path = output_path
+        self.progress = 0
+        self.submit_time = datetime.now()
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.error = None
+    
+    def to_dict(self):
+        return {campo: getattr(self, campo) for campo in self.__slots__
+                if getattr(self, campo) is not None}
+
 class VideoProcessor:
+    # Máximo de tareas terminadas que se conservan para consultar su estado
+    MAX_TAREAS_TERMINADAS = 1024
+    
     _instance = None
     _lock = Lock()
     
@@ -27,25 +78,96 @@ class VideoProcessor:
             return
             
         self._initialized = True
-        self.task_queue = Queue()
-        self.active_tasks = {}
-        self.completed_tasks = {}
-        self.queued_tasks = {}
+        # Una cola por worker; las tareas se reparten por turnos y un worker
+        # sin trabajo roba de las colas de los demás
+        self.queues = [Queue()]
+        self._turno = itertools.count()
+        # task_id -> TaskRecord; las inserciones y lecturas de un dict son atómicas
+        # en CPython, así que consultar el estado no bloquea a los workers
+        self.tasks = {}
+        # next() sobre itertools.count es atómico bajo el GIL: IDs únicos sin lock
+        self._task_counter = itertools.count(1)
+        # IDs de las tareas terminadas, de la más antigua a la más reciente
+        self._terminadas = deque()
+        # Procesos FFmpeg en ejecución, para terminarlos al detener los workers
+        self._active_procs = set()
+        self._procs_lock = Lock()
         self._stop_event = False
         self.workers = []
         self.worker_count = 0
-        self.lock = Lock()
+        self.workers_lock = Lock()
         
         # Configuración por defecto de transcodificación
         self.default_config = {
             'video_codec': 'libx264',
-            'preset': 'medium',
+            'preset': 'veryfast',
+            'tune': 'fastdecode',  # Salida más ligera de decodificar en los reproductores
             'crf': '20',  # Calidad aumentada (valor más bajo = más calidad)
             'audio_codec': 'aac',
             'audio_bitrate': '192k', # Calidad de audio aumentada
             'pix_fmt': 'yuv420p',
             'output_extension': '.mp4'
         }
+        
+        # Resultado de la detección de NVENC (None = aún no comprobado)
+        self._nvenc_disponible = None
+        self._nvenc_lock = Lock()
+    
+    def nvenc_disponible(self):
+        """Indica si FFmpeg puede codificar con h264_nvenc en este equipo.
+        
+        La comprobación se hace una sola vez y se guarda en caché. Además de buscar
+        el codificador en `ffmpeg -encoders` se codifica un fotograma de prueba, porque
+        un FFmpeg compilado con NVENC no implica que haya una GPU NVIDIA utilizable.
+        """
+        with self._nvenc_lock:
+            if self._nvenc_disponible is None:
+                self._nvenc_disponible = self._detectar_nvenc()
+                logger.info(f"Codificación por hardware NVENC {'disponible' if self._nvenc_disponible else 'no disponible'}")
+            return self._nvenc_disponible
+    
+    @staticmethod
+    def _detectar_nvenc():
+        try:
+            encoders = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                timeout=10
+            )
+            if 'h264_nvenc' not in encoders.stdout:
+                return False
+            
+            prueba = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-nostdin', '-v', 'error',
+                 '-f', 'lavfi', '-i', 'color=size=256x144:rate=1',
+                 '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=20
+            )
+            return prueba.returncode == 0
+        except Exception as e:
+            logger.warning(f"No se pudo comprobar la disponibilidad de NVENC: {str(e)}")
+            return False
+    
+    def get_transcode_config(self):
+        """Devuelve la configuración de transcodificación para este equipo.
+        
+        Usa h264_nvenc con decodificación y escalado en la GPU si está disponible;
+        en caso contrario, la configuración por defecto con libx264.
+        """
+        if not self.nvenc_disponible():
+            return self.default_config
+        return {
+            **self.default_config,
+            'video_codec': 'h264_nvenc',
+            'preset': 'p4',
+            'hwaccel': 'cuda'
+        }
     
     def start_workers(self, num_workers=None):
         """Inicia los workers para procesar tareas en segundo plano.
@@ -53,7 +175,7 @@ class VideoProcessor:
         Args:
             num_workers: Número de workers a iniciar. Si es None, se usará el número de CPUs - 1.
         """
-        with self.lock:
+        with self.workers_lock:
             if self.workers:
                 logger.warning("Los workers ya están en ejecución")
                 return
@@ -63,11 +185,15 @@ class VideoProcessor:
             
             self._stop_event = False
             self.workers = []
+            while len(self.queues) < num_workers:
+                self.queues.append(Queue())
             
-            for _ in range(num_workers):
+            cpus_por_worker = _repartir_cpus(num_workers)
+            for indice in range(num_workers):
                 self.worker_count += 1
                 worker = Thread(
                     target=self._worker_loop,
+                    args=(indice, cpus_por_worker[indice]),
                     daemon=True,
                     name=f'VideoWorker-{self.worker_count}'
                 )
@@ -76,75 +202,170 @@ class VideoProcessor:
             
             logger.info(f"Iniciados {num_workers} workers de transcodificación")
     
-    def _worker_loop(self):
+    def _encolar(self, task):
+        """Coloca una tarea en la siguiente cola por turnos."""
+        colas = self.queues
+        colas[next(self._turno) % len(colas)].put(task)
+    
+    def _siguiente_tarea(self, indice):
+        """Obtiene la siguiente tarea para el worker `indice`.
+        
+        Espera hasta 1 segundo en la cola propia y, si está vacía, intenta robar
+        una tarea de las colas de los demás workers sin bloquearse.
+        
+        Returns:
+            tuple: (cola de origen, tarea) o (None, None) si no hay trabajo
+        """
+        colas = self.queues
+        propia = colas[indice]
+        try:
+            return propia, propia.get(timeout=1)
+        except Empty:
+            pass
+        
+        for desplazamiento in range(1, len(colas)):
+            cola = colas[(indice + desplazamiento) % len(colas)]
+            try:
+                return cola, cola.get_nowait()
+            except Empty:
+                continue
+        return None, None
+    
+    def _worker_loop(self, indice=0, cpus=None):
         """Bucle principal del worker que procesa tareas de la cola."""
+        _hilo.cpus = cpus
         while not self._stop_event:
             try:
-                try:
-                    task = self.task_queue.get(timeout=1)
-                except Empty:
+                cola, task = self._siguiente_tarea(indice)
+                if cola is None:
                     continue
                     
                 if task is None:
                     break
-                    
-                task_id, task_func, args, kwargs = task
-
-                task_info = {}
-                with self.lock:
-                    if task_id in self.queued_tasks:
-                        task_info = self.queued_tasks.pop(task_id)
-                    task_info.update({
-                        'start_time': datetime.now(),
-                        'status': 'processing',
-                        'progress': 0
-                    })
-                    self.active_tasks[task_id] = task_info
+                
+                lote = [task]
+                if task[1] is transcode_video:
+                    lote.extend(self._drain_transcode_batch(task, cola))
                 
                 try:
-                    result = task_func(*args, **kwargs)
-
-                    if result.get('success'):
-                        with self.lock:
-                            completed_task_info = self.active_tasks.pop(task_id, task_info)
-                            completed_task_info.update({
-                                'end_time': datetime.now(),
-                                'status': 'completed',
-                                'result': result,
-                                'progress': 100
-                            })
-                            self.completed_tasks[task_id] = completed_task_info
+                    if len(lote) > 1:
+                        self._procesar_lote(lote)
                     else:
-                        error_msg = result.get('error', 'Unknown error during task execution')
-                        logger.error(f"Task {task_id} failed: {error_msg}")
-                        with self.lock:
-                            failed_task_info = self.active_tasks.pop(task_id, task_info)
-                            failed_task_info.update({
-                                'end_time': datetime.now(),
-                                'status': 'failed',
-                                'error': error_msg
-                            })
-                            self.completed_tasks[task_id] = failed_task_info
-
-                except Exception as e:
-                    error_msg = f"Unexpected exception while processing task {task_id}: {str(e)}"
-                    logger.error(error_msg, exc_info=True)
-                    with self.lock:
-                        failed_task_info = self.active_tasks.pop(task_id, task_info)
-                        failed_task_info.update({
-                            'end_time': datetime.now(),
-                            'status': 'failed',
-                            'error': error_msg
-                        })
-                        self.completed_tasks[task_id] = failed_task_info
+                        self._procesar_tarea(task)
                 finally:
-                    self.task_queue.task_done()
+                    for _ in lote:
+                        cola.task_done()
                     
             except Exception as e:
                 if not self._stop_event:
                     logger.error(f"Unexpected error in worker loop: {str(e)}", exc_info=True)
                     time.sleep(1)
     
+    @staticmethod
+    def _clave_config(config):
+        return None if config is None else tuple(sorted(config.items()))
+    
+    def _drain_transcode_batch(self, task, cola, max_batch=8, timeout=0.05):
+        """Saca de la cola las transcodificaciones pendientes con la misma configuración que `task`.
+        
+        Si no hay nada más en la cola vuelve enseguida; si encuentra compañeras, espera
+        como mucho `timeout` segundos a que llegue el resto de la ráfaga. Devuelve hasta
+        `max_batch - 1` tareas adicionales, conservando el orden de la cola, y nunca más
+        que CPUs tiene el worker para no saturar su grupo de CPUs.
+        """
+        cpus = getattr(_hilo, 'cpus', None)
+        if cpus:
+            max_batch = min(max_batch, len(cpus))
+        clave = self._clave_config(task[3].get('config'))
+        lote = []
+        limite = time.monotonic() + timeout
+        
+        while len(lote) < max_batch - 1:
+            with cola.mutex:
+                for pendiente in list(cola.queue):
+                    if len(lote) >= max_batch - 1:
+                        break
+                    if (pendiente is not None and pendiente[1] is transcode_video and
+                            self._clave_config(pendiente[3].get('config')) == clave):
+                        cola.queue.remove(pendiente)
+                        lote.append(pendiente)
+            
+            # Una tarea sola no espera: solo merece la pena aguardar durante una ráfaga
+            if not lote:
+                break
+            restante = limite - time.monotonic()
+            if restante <= 0 or self._stop_event:
+                break
+            time.sleep(min(restante, 0.01))
+        
+        return lote
+    
+    def _marcar_activa(self, task_id):
+        record = self.tasks.get(task_id)
+        if record is None:
+            record = self.tasks[task_id] = TaskRecord(task_id)
+        record.start_time = datetime.now()
+        record.progress = 0
+        record.status = 'processing'
+        return record
+    
+    def _marcar_terminada(self, record, result=None, error_msg=None):
+        record.end_time = datetime.now()
+        if result is not None and result.get('success'):
+            record.result = result
+            record.progress = 100
+            record.status = 'completed'
+        else:
+            if error_msg is None:
+                error_msg = result.get('error', 'Unknown error during task execution')
+                if self._stop_event:
+                    # Fallo esperado: stop_workers terminó el FFmpeg de la tarea
+                    logger.info(f"Task {record.task_id} interrumpida al detener los workers")
+                else:
+                    logger.error(f"Task {record.task_id} failed: {error_msg}")
+            record.error = error_msg
+            record.status = 'failed'
+        
+        # Olvidar las tareas terminadas más antiguas para que la memoria no crezca sin límite
+        self._terminadas.append(record.task_id)
+        while len(self._terminadas) > self.MAX_TAREAS_TERMINADAS:
+            try:
+                self.tasks.pop(self._terminadas.popleft(), None)
+            except IndexError:
+                break
+    
+    def _procesar_tarea(self, task, record=None):
+        task_id, task_func, args, kwargs = task
+        if record is None:
+            record = self._marcar_activa(task_id)
+        try:
+            result = task_func(*args, **kwargs)
+            self._marcar_terminada(record, result)
+        except ProcesadorDetenido as e:
+            logger.info(f"Task {task_id} interrumpida: {str(e)}")
+            self._marcar_terminada(record, error_msg=str(e))
+        except Exception as e:
+            error_msg = f"Unexpected exception while processing task {task_id}: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            self._marcar_terminada(record, error_msg=error_msg)
+    
+    def _procesar_lote(self, lote):
+        """Transcodifica varias tareas con una sola invocación de FFmpeg."""
+        records = {task_id: self._marcar_activa(task_id) for task_id, _, _, _ in lote}
+        try:
+            resultados = transcode_batch([kwargs for _, _, _, kwargs in lote])
+        except Exception as e:
+            logger.error(f"Unexpected exception while processing batch: {str(e)}", exc_info=True)
+            resultados = {}
+        
+        for task in lote:
+            task_id = task[0]
+            if task_id in resultados:
+                self._marcar_terminada(records[task_id], resultados[task_id])
+            else:
+                # El lote falló sin poder atribuir el error: procesar la tarea por separado
+                self._procesar_tarea(task, records[task_id])
+    
     def submit_task(self, task_func, *args, **kwargs):
         """Envía una tarea a la cola de procesamiento.
         
@@ -155,8 +376,9 @@ class VideoProcessor:
         Returns:
             str: ID de la tarea
         """
-        task_id = f"task_{len(self.active_tasks) + len(self.completed_tasks) + len(self.queued_tasks) + 1}"
-        self.task_queue.put((task_id, task_func, args, kwargs))
+        task_id = f"task_{next(self._task_counter)}"
+        self.tasks[task_id] = TaskRecord(task_id)
+        self._encolar((task_id, task_func, args, kwargs))
         return task_id
     
     def get_task_status(self, task_id):
@@ -168,28 +390,44 @@ class VideoProcessor:
         Returns:
             dict: Estado de la tarea o None si no existe
         """
-        with self.lock:
-            if task_id in self.active_tasks:
-                return {'status': 'processing', **self.active_tasks[task_id]}
-            elif task_id in self.completed_tasks:
-                return self.completed_tasks[task_id]
-            elif task_id in self.queued_tasks:
-                return {'status': 'queued', **self.queued_tasks[task_id]}
+        record = self.tasks.get(task_id)
+        return record.to_dict() if record is not None else None
+    
+    def find_task(self, filename, status=None):
+        """Busca la tarea más reciente de un archivo.
+        
+        Args:
+            filename: Nombre del archivo original
+            status: Si se indica, solo se consideran tareas en ese estado
+            
+        Returns:
+            TaskRecord o None si no hay ninguna
+        """
+        for record in reversed(list(self.tasks.values())):
+            if record.filename == filename and (status is None or record.status == status):
+                return record
         return None
     
+    def update_progress(self, task_id, progress):
+        """Actualiza el progreso de una tarea activa si ha avanzado."""
+        record = self.tasks.get(task_id)
+        if record is not None and progress > record.progress:
+            record.progress = progress
+    
     def stop_workers(self):
         """Detiene todos los workers y limpia recursos."""
-        with self.lock:
+        with self.workers_lock:
             if not self.workers:
                 logger.info("No hay workers activos para detener")
                 return
                 
             logger.info("Deteniendo workers de transcodificación...")
             self._stop_event = True
+            self._terminar_procesos()
             
             # Enviar señal de parada a todos los workers
-            for _ in self.workers:
-                self.task_queue.put(None)
+            for indice in range(len(self.workers)):
+                self.queues[indice].put(None)
             
             # Esperar a que los workers terminen
             for worker in self.workers:
@@ -199,22 +437,81 @@ class VideoProcessor:
                         logger.warning(f"Worker {worker.name} no se detuvo correctamente")
             
             self.workers = []
-            self.active_tasks.clear()
+            for task_id, record in list(self.tasks.items()):
+                if record.status == 'processing':
+                    self.tasks.pop(task_id, None)
             logger.info("Todos los workers han sido detenidos")
     
+    def lanzar_proceso(self, cmd, **kwargs):
+        """Inicia un proceso FFmpeg y lo registra para poder terminarlo en stop_workers.
+        
+        El proceso va en su propia sesión, así que un Ctrl-C en la terminal no le llega
+        directamente: lo termina stop_workers de forma ordenada.
+        
+        Raises:
+            ProcesadorDetenido: Si los workers se están deteniendo
+        """
+        with self._procs_lock:
+            # Comprobar bajo el lock: stop_workers marca la parada antes de recorrer los procesos
+            if self._stop_event:
+                raise ProcesadorDetenido("El procesador de video se está deteniendo")
+            proceso = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+            self._active_procs.add(proceso)
+        return proceso
+    
+    def liberar_proceso(self, proceso):
+        with self._procs_lock:
+            self._active_procs.discard(proceso)
+    
+    def _terminar_procesos(self):
+        """Termina los procesos FFmpeg en curso (SIGTERM y, si no responden en 2 s, SIGKILL)."""
+        with self._procs_lock:
+            procesos = list(self._active_procs)
+        
+        # Cada proceso lidera su propio grupo (start_new_session): la señal llega
+        # también a cualquier hijo que mantenga abierta la tubería de progreso
+        for proceso in procesos:
+            if proceso.poll() is None:
+                _senal_grupo(proceso, signal.SIGTERM)
+        
+        limite = time.monotonic() + 2
+        for proceso in procesos:
+            try:
+                proceso.wait(timeout=max(0, limite - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"FFmpeg (PID {proceso.pid}) no respondió a SIGTERM, forzando cierre")
+                _senal_grupo(proceso, signal.SIGKILL)
+                proceso.wait()
+    
     def get_active_task_count(self):
         """Obtiene el número de tareas activas."""
-        with self.lock:
-            return len(self.active_tasks)
+        return sum(1 for record in list(self.tasks.values()) if record.status == 'processing')
     
     def get_queue_size(self):
         """Obtiene el número de tareas en cola."""
-        return self.task_queue.qsize()
+        return sum(cola.qsize() for cola in self.queues)
+    
+    def _tras_fork(self):
+        """Restablece el procesador en un proceso hijo (p. ej. `gunicorn --preload`).
+        
+        Los hilos no sobreviven a fork(): el hijo heredaría la lista de workers del
+        padre, ya muertos, y start_workers() se negaría a arrancar otros nuevos.
+        """
+        num_workers = len(self.workers)
+        self.workers_lock = Lock()
+        self._procs_lock = Lock()
+        self._nvenc_lock = Lock()
+        self._active_procs = set()
+        self.queues = [Queue() for _ in self.queues]
+        self.workers = []
+        if num_workers and not self._stop_event:
+            self.start_workers(num_workers)
     
     def get_worker_count(self):
         """Obtiene el número de workers activos."""
-        with self.lock:
-            return len([w for w in self.workers if w.is_alive()])
+        # Sin lock: stop_workers lo mantiene mientras espera a los hilos (hasta 5 s por worker)
+        # y las subidas consultan este valor; basta con una copia de la lista
+        return sum(1 for w in list(self.workers) if w.is_alive())
     
     def submit_transcode_task(self, input_path, output_path=None, config=None):
         """Envía una tarea de transcodificación a la cola.
@@ -239,9 +536,9 @@ class VideoProcessor:
                     f"{base_name}.mp4"
                 )
             
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            _fd_directorio(os.path.dirname(output_path))
 
-            task_id = f"task_{len(self.active_tasks) + len(self.completed_tasks) + len(self.queued_tasks) + 1}"
+            task_id = f"task_{next(self._task_counter)}"
 
             task_kwargs = {
                 'input_path': input_path,
@@ -250,15 +547,15 @@ class VideoProcessor:
                 'task_id': task_id
             }
 
-            self.task_queue.put((task_id, transcode_video, (), task_kwargs))
+            # Registrar la tarea antes de encolarla para que un worker no la tome sin su información
+            self.tasks[task_id] = TaskRecord(
+                task_id,
+                filename=os.path.basename(input_path),
+                input_path=input_path,
+                output_path=output_path
+            )
 
-            with self.lock:
-                self.queued_tasks[task_id] = {
-                    'filename': os.path.basename(input_path),
-                    'input_path': input_path,
-                    'output_path': output_path,
-                    'submit_time': datetime.now()
-                }
+            self._encolar((task_id, transcode_video, (), task_kwargs))
             
             logger.info(f"Tarea de transcodificación enviada (ID: {task_id}): {input_path} -> {output_path}")
             return task_id, output_path
@@ -268,128 +565,549 @@ class VideoProcessor:
             logger.error(error_msg, exc_info=True)
             return None, error_msg
 
-def transcode_video(input_path, output_path, config=None, task_id=None):
-    """Transcodifica un video al formato óptimo para transmisión de forma atómica.
+def _repartir_cpus(num_workers):
+    """Divide las CPUs disponibles en grupos disjuntos y contiguos, uno por worker.
     
-    Args:
-        input_path: Ruta al archivo de entrada
-        output_path: Ruta donde guardar el archivo de salida final
-        config: Configuración de transcodificación (opcional)
-        task_id: ID de la tarea para actualizar el progreso
-        
-    Returns:
-        dict: Resultado de la operación
+    Con un solo worker (o sin soporte de afinidad en el sistema) no se restringe nada.
     """
-    processor = VideoProcessor()
-    if config is None:
-        config = processor.default_config
+    if num_workers <= 1 or not hasattr(os, 'sched_getaffinity'):
+        return [None] * num_workers
     
-    temp_output_path = output_path + ".tmp"
+    cpus = sorted(os.sched_getaffinity(0))
+    if num_workers >= len(cpus):
+        return [{cpus[i % len(cpus)]} for i in range(num_workers)]
+    return [set(cpus[i * len(cpus) // num_workers:(i + 1) * len(cpus) // num_workers])
+            for i in range(num_workers)]
+
+@functools.lru_cache(maxsize=None)
+def _ruta_programa(nombre):
+    return shutil.which(nombre)
+
+def _prefijo_ajuste():
+    """Prefijo `nice`/`taskset` para lanzar FFmpeg a menor prioridad y en las CPUs del worker.
     
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    if os.path.exists(temp_output_path):
-        os.remove(temp_output_path)
+    Se aplica antes del exec, así que todos los hilos que FFmpeg cree heredan la
+    prioridad y la afinidad (ajustarlas desde el padre tras lanzarlo solo afecta
+    al hilo principal). Sin preexec_fn, que no es seguro en un proceso con hilos.
+    """
+    prefijo = []
+    nice = _ruta_programa('nice')
+    if nice:
+        prefijo += [nice, '-n', str(NICE_TRANSCODIFICACION)]
+    cpus = getattr(_hilo, 'cpus', None)
+    taskset = _ruta_programa('taskset') if cpus else None
+    if taskset:
+        prefijo += [taskset, '-c', ','.join(str(cpu) for cpu in sorted(cpus))]
+    return prefijo
 
-    total_duration = get_video_duration(input_path)
+def _hilos_codificador():
+    """Número de hilos para x264 según las CPUs del worker actual, o None para el valor por defecto."""
+    cpus = getattr(_hilo, 'cpus', None)
+    return len(cpus) if cpus else None
+
+def _parametros_video(config, threads=None, escalar=True):
+    """Devuelve (parámetros de entrada, parámetros de video de salida) para `config`.
     
-    audio_params = [
+    Con config['hwaccel'] == 'cuda' la decodificación, el escalado y la codificación
+    (h264_nvenc) se hacen en la GPU; si no, se usa el codificador por software.
+    Con escalar=False no se añade el filtro de escalado a 720p.
+    """
+    if config.get('hwaccel') == 'cuda':
+        input_params = ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+        # Los fotogramas se quedan en memoria de la GPU: sin -pix_fmt, NVENC usa su formato nativo
+        video_params = [
+            '-c:v', config['video_codec'],
+            '-preset', config['preset'],
+            '-tune', 'hq',
+            '-rc', 'vbr',
+            '-cq', str(config['crf']),
+            '-b:v', '0',
+        ]
+        if escalar:
+            video_params += ['-vf', 'scale_cuda=-2:720']
+    else:
+        input_params = []
+        video_params = [
+            '-c:v', config['video_codec'],
+            '-preset', config['preset'],
+            '-tune', config['tune'],
+            '-crf', str(config['crf']),
+            '-pix_fmt', config['pix_fmt'],
+        ]
+        if escalar:
+            video_params += ['-vf', 'scale=-2:720']
+        if threads:
+            video_params += ['-threads', str(threads)]
+    return input_params, video_params
+
+def _parametros_audio(config):
+    return [
         '-c:a', config['audio_codec'],
         '-b:a', config['audio_bitrate'],
         '-ac', '2',
         '-ar', '44100'
     ]
+
+def _stream_video(info):
+    return next((st for st in info.get('streams', []) if st.get('codec_type') == 'video'), None)
+
+def _rotacion(video):
+    """Devuelve la rotación en grados del stream de video según sus metadatos (0 si no tiene)."""
+    for datos in video.get('side_data_list') or []:
+        if 'rotation' in datos:
+            return int(float(datos['rotation']))
+    return int(float((video.get('tags') or {}).get('rotate') or 0))
+
+def _altura_visible(video):
+    """Altura con la que se muestra el video: si está girado 90/270 grados es su anchura."""
+    if abs(_rotacion(video)) % 180 == 90:
+        return int(video.get('width') or 0)
+    return int(video.get('height') or 0)
+
+def necesita_escalar(input_path):
+    """Indica si el video se muestra con más de 720 líneas (o no se puede saber) y hay que reducirlo."""
+    try:
+        video = _stream_video(get_video_info(input_path))
+        if video is None:
+            return True
+        altura = _altura_visible(video)
+        return altura == 0 or altura > 720
+    except Exception:
+        return True
+
+def admite_copia(input_path):
+    """Indica si un video ya cumple el formato de salida y basta con copiar los streams.
     
-    cmd = [
+    Requiere contenedor MP4 con video H.264 yuv420p que se muestre con como mucho
+    720 líneas (teniendo en cuenta la rotación) y, si hay audio, que sea AAC.
+    """
+    try:
+        info = get_video_info(input_path)
+        streams = info.get('streams', [])
+        video = _stream_video(info)
+        if video is None:
+            return False
+        return (
+            video.get('codec_name') == 'h264' and
+            video.get('pix_fmt') == 'yuv420p' and
+            0 < _altura_visible(video) <= 720 and
+            'mp4' in info.get('format', {}).get('format_name', '').split(',') and
+            all(st.get('codec_name') == 'aac' for st in streams if st.get('codec_type') == 'audio')
+        )
+    except Exception as e:
+        logger.debug(f"No se pudo comprobar el formato de {input_path}: {str(e)}")
+        return False
+
+def build_copy_cmd(input_path, output_path):
+    """Construye el comando FFmpeg que copia los streams sin recodificar."""
+    return [
+        'ffmpeg',
+        '-y',
+        '-nostdin',
+        '-nostats',
+        '-i', input_path,
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-progress', DESTINO_PROGRESO,
+        '-f', 'mp4',
+        output_path
+    ]
+
+def build_transcode_cmd(input_path, output_path, config, threads=None):
+    """Construye el comando FFmpeg de transcodificación a 720p."""
+    input_params, video_params = _parametros_video(config, threads, necesita_escalar(input_path))
+    return [
         'ffmpeg',
         '-y',
         '-nostdin',  # Evitar que ffmpeg lea de stdin y se cuelgue
+        '-nostats',
+        *input_params,
         '-i', input_path,
-        '-c:v', config['video_codec'],
-        '-preset', config['preset'],
-        '-crf', str(config['crf']),
-        '-vf', 'scale=-2:720',
-        '-pix_fmt', config['pix_fmt'],
+        *video_params,
         '-movflags', '+faststart',
-        *audio_params,
-        '-progress', '-',  # Reactivar el progreso para la UI
+        *_parametros_audio(config),
+        '-progress', DESTINO_PROGRESO,  # Progreso para la UI
         '-f', 'mp4',
-        temp_output_path
+        output_path
     ]
+
+_CLAVE_PROGRESO = b'out_time_ms='
+
+# Marcador del destino de -progress; _ejecutar_ffmpeg lo sustituye por su tubería
+DESTINO_PROGRESO = '{progreso}'
+
+def _leer_progreso(fd, reportar):
+    """Lee la salida de `-progress` de FFmpeg en binario hasta EOF y reporta cada out_time_ms.
     
-    logger.info(f"Iniciando transcodificación: {' '.join(cmd)}")
+    No decodifica ni separa líneas: busca la clave directamente en los bytes leídos.
     
+    Args:
+        fd: Descriptor de lectura con la salida de `-progress`
+        reportar: Función que recibe el tiempo procesado en microsegundos
+    """
+    buf = bytearray()
+    
+    while True:
+        bloque = os.read(fd, 4096)
+        if not bloque:
+            break
+        buf += bloque
+        
+        inicio = 0
+        while True:
+            idx = buf.find(_CLAVE_PROGRESO, inicio)
+            if idx < 0:
+                break
+            nl = buf.find(b'\n', idx)
+            if nl < 0:
+                break
+            try:
+                reportar(int(buf[idx + len(_CLAVE_PROGRESO):nl]))
+            except ValueError:
+                pass  # out_time_ms=N/A al inicio
+            inicio = nl + 1
+        
+        # Conservar solo la línea incompleta final
+        ultimo_nl = buf.rfind(b'\n')
+        if ultimo_nl >= 0:
+            del buf[:ultimo_nl + 1]
+
+def _ejecutar_ffmpeg(cmd, reportar):
+    """Ejecuta un comando FFmpeg de transcodificación y espera a que termine.
+    
+    El progreso llega por una tubería propia (`-progress pipe:N`, en lugar del marcador
+    DESTINO_PROGRESO del comando), así que Python solo lee unas decenas de bytes por
+    segundo. Los mensajes del codificador van a un archivo temporal que solo se lee
+    si FFmpeg falla.
+    
+    Returns:
+        tuple: (código de salida, últimos 2000 caracteres de stderr si falló)
+    """
+    processor = VideoProcessor()
+    lectura, escritura = os.pipe()
     try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1,
-            errors='replace'
-        )
+        cmd = _prefijo_ajuste() + [f'pipe:{escritura}' if arg == DESTINO_PROGRESO else arg
+                                    for arg in cmd]
+        with tempfile.TemporaryFile() as errores:
+            try:
+                process = processor.lanzar_proceso(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=errores,
+                    pass_fds=(escritura,)
+                )
+            finally:
+                # Cerrar nuestra copia para recibir EOF cuando FFmpeg termine
+                os.close(escritura)
+            
+            try:
+                _leer_progreso(lectura, reportar)
+                process.wait()
+            finally:
+                processor.liberar_proceso(process)
+            
+            if process.returncode == 0:
+                return 0, ''
+            tamano = errores.seek(0, os.SEEK_END)
+            errores.seek(max(0, tamano - 2000))
+            return process.returncode, errores.read().decode('utf-8', errors='replace')
+    finally:
+        os.close(lectura)
+
+def _reportador_progreso(processor, task_ids, total_duration):
+    """Crea la función que traduce out_time_ms a porcentaje para `_leer_progreso`.
+    
+    FFmpeg informa varias veces por segundo; el progreso de las tareas solo se
+    actualiza una vez por segundo o cuando avanza al menos 5 puntos.
+    """
+    ultimo_momento = 0.0
+    ultimo_progreso = 0
+    
+    def reportar(current_time_us):
+        nonlocal ultimo_momento, ultimo_progreso
+        if total_duration <= 0:
+            return
+        progress = min(99, int((current_time_us / (total_duration * 1000000)) * 100))
+        ahora = time.monotonic()
+        if ahora - ultimo_momento < 1.0 and progress - ultimo_progreso < 5:
+            return
+        ultimo_momento = ahora
+        ultimo_progreso = progress
+        for task_id in task_ids:
+            processor.update_progress(task_id, progress)
+    
+    return reportar
+
+# Descriptores abiertos de los directorios de salida, por ruta
+_dir_fds = {}
+_dir_fds_lock = Lock()
+
+def _fd_directorio(directorio):
+    """Devuelve un descriptor abierto del directorio, creándolo si no existe.
+    
+    Se guarda en caché para no repetir makedirs ni la resolución de la ruta en cada
+    tarea. Si el directorio se borró desde entonces (st_nlink == 0), se vuelve a crear.
+    """
+    fd = _dir_fds.get(directorio)
+    if fd is not None and os.fstat(fd).st_nlink > 0:
+        return fd
+    with _dir_fds_lock:
+        fd = _dir_fds.get(directorio)
+        if fd is not None and os.fstat(fd).st_nlink > 0:
+            return fd
+        if fd is not None:
+            os.close(fd)
+        os.makedirs(directorio, exist_ok=True)
+        fd = os.open(directorio, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        _dir_fds[directorio] = fd
+        return fd
+
+def _crear_temporal(output_path):
+    """Crea un archivo temporal único junto a `output_path` y devuelve su ruta.
+    
+    Está en el mismo directorio (y sistema de archivos) que el destino para que
+    os.replace sea atómico, y lleva un nombre oculto que no termina en .mp4 para
+    que no aparezca en los listados mientras se escribe.
+    """
+    directorio, nombre = os.path.split(output_path)
+    _fd_directorio(directorio)
+    with tempfile.NamedTemporaryFile(dir=directorio, prefix=f'.{nombre}.', suffix='.tmp', delete=False) as tmp:
+        return tmp.name
+
+def _publicar(temp_output_path, output_path):
+    """Mueve el temporal a su nombre definitivo, relativo al descriptor del directorio.
+    
+    Returns:
+        int: Tamaño del archivo publicado, o 0 si el temporal está vacío (no se publica)
+    """
+    fd = _fd_directorio(os.path.dirname(output_path))
+    nombre_temporal = os.path.basename(temp_output_path)
+    size = os.stat(nombre_temporal, dir_fd=fd).st_size
+    if size:
+        os.replace(nombre_temporal, os.path.basename(output_path), src_dir_fd=fd, dst_dir_fd=fd)
+    return size
+
+def _eliminar_temporal(temp_output_path):
+    try:
+        os.unlink(temp_output_path)
+    except FileNotFoundError:
+        pass
+
+def transcode_batch(jobs):
+    """Transcodifica varios videos con una única invocación de FFmpeg.
+    
+    Todas las tareas deben compartir configuración. Cada entrada se mapea a su propia
+    salida temporal, de modo que el arranque de FFmpeg y la inicialización de los
+    códecs se pagan una sola vez. El progreso que informa FFmpeg es global, así que
+    se reparte igual entre las tareas del lote respecto a la duración más larga.
+    
+    Args:
+        jobs: Lista de kwargs de transcode_video (input_path, output_path, config, task_id)
         
-        output_lines = []
-        for line in process.stdout:
-            line = line.strip()
-            output_lines.append(line)
-            if not line:
-                continue
+    Returns:
+        dict: task_id -> resultado, solo para las tareas resueltas. Si FFmpeg falla,
+        las tareas del lote no aparecen para que cada una se reintente por separado.
+    """
+    processor = VideoProcessor()
+    config = jobs[0].get('config') or processor.get_transcode_config()
+    
+    # Los videos que ya están en el formato de salida se copian por separado, sin codificar
+    resultados = {}
+    pendientes = []
+    for job in jobs:
+        if admite_copia(job['input_path']):
+            resultados[job['task_id']] = transcode_video(**job)
+        else:
+            pendientes.append(job)
+    if not pendientes:
+        return resultados
+    jobs = pendientes
+    task_ids = [job['task_id'] for job in jobs]
+    
+    temporales = []
+    for job in jobs:
+        temporales.append(_crear_temporal(job['output_path']))
+    
+    total_duration = max(get_video_duration(job['input_path']) for job in jobs)
+    
+    # Repartir los hilos del worker entre las salidas del lote en lugar de dar a cada una todos
+    threads = _hilos_codificador()
+    if threads:
+        threads = max(1, threads // len(jobs))
+    input_params, _ = _parametros_video(config, threads)
+    cmd = ['ffmpeg', '-y', '-nostdin', '-nostats', '-progress', DESTINO_PROGRESO]
+    for job in jobs:
+        cmd += [*input_params, '-i', job['input_path']]
+    for n, (job, temp_output_path) in enumerate(zip(jobs, temporales)):
+        _, video_params = _parametros_video(config, threads, necesita_escalar(job['input_path']))
+        cmd += [
+            '-map', f'{n}:v:0',
+            '-map', f'{n}:a:0?',
+            *video_params,
+            '-movflags', '+faststart',
+            *_parametros_audio(config),
+            '-f', 'mp4',
+            temp_output_path
+        ]
 
-            if total_duration > 0 and 'out_time_ms' in line:
-                try:
-                    current_time_us = int(line.split('=')[1].strip())
-                    progress = min(99, int((current_time_us / (total_duration * 1000000)) * 100))
-                    if task_id:
-                        with processor.lock:
-                            if task_id in processor.active_tasks:
-                                if progress > processor.active_tasks[task_id].get('progress', 0):
-                                    processor.active_tasks[task_id]['progress'] = progress
-                except (ValueError, IndexError):
-                    pass
-
-        process.wait()
-        
-        if process.returncode != 0:
-            full_output = "\n".join(output_lines)
-            error_msg = f"Error en la transcodificación (código {process.returncode}). Salida de FFmpeg:\n{full_output[-2000:]}"
+    logger.info(f"Iniciando transcodificación por lotes de {len(jobs)} videos: {' '.join(cmd)}")
+    
+    try:
+        returncode, _ = _ejecutar_ffmpeg(cmd, _reportador_progreso(processor, task_ids, total_duration))
+    except ProcesadorDetenido as e:
+        logger.info(f"Transcodificación por lotes cancelada: {str(e)}")
+        returncode = None
+    except Exception as e:
+        logger.error(f"Error inesperado en la transcodificación por lotes: {str(e)}", exc_info=True)
+        returncode = None
+    
+    if returncode != 0:
+        if processor._stop_event:
+            logger.info("Transcodificación por lotes interrumpida al detener los workers")
+        elif returncode is not None:
+            logger.warning(f"La transcodificación por lotes falló (código {returncode}), se procesará cada video por separado")
+        for temp_output_path in temporales:
+            _eliminar_temporal(temp_output_path)
+        return resultados
+    
+    for job, temp_output_path in zip(jobs, temporales):
+        output_path = job['output_path']
+        size = _publicar(temp_output_path, output_path)
+        if not size:
+            error_msg = "El archivo de salida temporal no se creó o está vacío."
+            logger.error(f"{error_msg} ({output_path})")
+            _eliminar_temporal(temp_output_path)
+            resultados[job['task_id']] = {'success': False, 'error': error_msg, 'returncode': -1}
+            continue
+        
+        logger.info(f"Transcodificación completada: {output_path}")
+        resultados[job['task_id']] = {
+            'success': True,
+            'output_path': output_path,
+            'size': size,
+            # La transcodificación conserva la duración: usar la del original, ya en caché
+            'duration': get_video_duration(job['input_path'])
+        }
+    return resultados
+
+def transcode_video(input_path, output_path, config=None, task_id=None, stream_copy=True):
+    """Transcodifica un video al formato óptimo para transmisión de forma atómica.
+    
+    Args:
+        input_path: Ruta al archivo de entrada
+        output_path: Ruta donde guardar el archivo de salida final
+        config: Configuración de transcodificación (opcional)
+        task_id: ID de la tarea para actualizar el progreso
+        stream_copy: Si el video ya está en el formato de salida, copiarlo sin recodificar
+        
+    Returns:
+        dict: Resultado de la operación
+    """
+    processor = VideoProcessor()
+    if config is None:
+        config = processor.get_transcode_config()
+    
+    temp_output_path = _crear_temporal(output_path)
+    completado = False
+
+    total_duration = get_video_duration(input_path)
+    
+    copia = stream_copy and admite_copia(input_path)
+    if copia:
+        cmd = build_copy_cmd(input_path, temp_output_path)
+    else:
+        cmd = build_transcode_cmd(input_path, temp_output_path, config, _hilos_codificador())
+    
+    logger.info(f"Iniciando transcodificación: {' '.join(cmd)}")
+    
+    try:
+        reportar = _reportador_progreso(processor, [task_id] if task_id else [], total_duration)
+        returncode, salida = _ejecutar_ffmpeg(cmd, reportar)
+        
+        if returncode != 0 and processor._stop_event:
+            # stop_workers terminó FFmpeg: no es un error ni tiene sentido reintentar
+            error_msg = "Transcodificación interrumpida al detener los workers"
+            logger.info(f"{error_msg}: {input_path}")
+            return {'success': False, 'error': error_msg, 'returncode': returncode}
+        
+        if returncode != 0:
+            error_msg = f"Error en la transcodificación (código {returncode}). Salida de FFmpeg:\n{salida}"
             logger.error(error_msg)
-            if os.path.exists(temp_output_path):
-                os.remove(temp_output_path)
-            return {'success': False, 'error': error_msg, 'returncode': process.returncode}
+            if copia:
+                logger.warning("La copia de streams falló, reintentando con transcodificación completa")
+                return transcode_video(input_path, output_path, config, task_id, stream_copy=False)
+            if config.get('hwaccel'):
+                # Algunos formatos de entrada no se pueden decodificar en la GPU: reintentar por software
+                logger.warning("La transcodificación por hardware falló, reintentando con libx264")
+                return transcode_video(input_path, output_path, processor.default_config, task_id, stream_copy=False)
+            return {'success': False, 'error': error_msg, 'returncode': returncode}
         
-        if not os.path.exists(temp_output_path) or os.path.getsize(temp_output_path) == 0:
+        size = _publicar(temp_output_path, output_path)
+        if not size:
             error_msg = "El archivo de salida temporal no se creó o está vacío."
             logger.error(error_msg)
             return {'success': False, 'error': error_msg, 'returncode': -1}
-        
-        os.rename(temp_output_path, output_path)
+        completado = True
         
         logger.info(f"Transcodificación completada: {output_path}")
         return {
             'success': True,
             'output_path': output_path,
-            'size': os.path.getsize(output_path),
-            'duration': get_video_duration(output_path)
+            'size': size,
+            # La transcodificación conserva la duración: no hace falta volver a sondear la salida
+            'duration': total_duration
         }
         
+    except ProcesadorDetenido as e:
+        logger.info(f"Transcodificación cancelada: {str(e)}")
+        return {'success': False, 'error': str(e)}
+    
     except Exception as e:
         error_msg = f"Error inesperado en la transcodificación: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
         return {'success': False, 'error': error_msg, 'exception': str(e)}
+    
+    finally:
+        if not completado:
+            _eliminar_temporal(temp_output_path)
+
+@functools.lru_cache(maxsize=256)
+def _sondear_video(file_path, mtime_ns, size):
+    # mtime_ns y size solo forman parte de la clave: si el archivo cambia, se vuelve a sondear.
+    # Los fallos se lanzan como excepción para que lru_cache no los guarde
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json',
+         '-show_format', '-show_streams', file_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe terminó con código {result.returncode}")
+    info = json.loads(result.stdout)
+    if not info:
+        raise ValueError("ffprobe no devolvió información")
+    return info
+
+def get_video_info(file_path):
+    """Obtiene los metadatos de ffprobe (format y streams) de un video.
+    
+    El resultado se guarda en caché por ruta, fecha de modificación y tamaño, así que
+    cada archivo se sondea una sola vez mientras no cambie. No debe modificarse.
+    Si ffprobe falla devuelve {} sin guardarlo, y la siguiente consulta lo reintenta.
+    """
+    st = os.stat(file_path)
+    try:
+        return _sondear_video(file_path, st.st_mtime_ns, st.st_size)
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.warning(f"No se pudo sondear {file_path}: {str(e)}")
+        return {}
 
 def get_video_duration(file_path):
     """Obtiene la duración de un video en segundos."""
     try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
-             '-of', 'default=noprint_wrappers=1:nokey=1', file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        return float(result.stdout.strip())
+        return float(get_video_info(file_path)['format']['duration'])
     except Exception as e:
         logger.error(f"Error al obtener duración de {file_path}: {str(e)}")
         return 0
@@ -400,3 +1118,7 @@ video_processor = VideoProcessor()
 # Limpieza al cerrar la aplicación
 import atexit
 atexit.register(video_processor.stop_workers)
+
+# Rearrancar los workers en los procesos hijos creados con fork()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=video_processor._tras_fork)
@@ -9,245 +9,176 @@ import os
 import sys
 import subprocess
 import shutil
+import stat
 import venv
 import platform
 import socket
+import struct
 import time
 import datetime
+import hashlib
+import functools
+import json
+import mmap
+import tarfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-def run_command(cmd, cwd=None, sudo=False):
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Tamaño del pipe para los comandos cuya salida se captura (F_SETPIPE_SZ)
+PIPE_SIZE = 1 << 20
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031) if fcntl else None
+
+def read_output(proc):
+    """Lee toda la salida de un proceso en bloques grandes"""
+    if F_SETPIPE_SZ and sys.platform.startswith('linux'):
+        try:
+            fcntl.fcntl(proc.stdout.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            pass
+    
+    chunks = []
+    while True:
+        chunk = proc.stdout.read1(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    proc.wait()
+    return b''.join(chunks).decode(errors='replace')
+
+def run_command(cmd, cwd=None, sudo=False, env=None, capture=False):
     """
     Ejecuta un comando en la terminal.
     
     Args:
-        cmd: Puede ser un string con el comando o una lista de argumentos
+        cmd: Lista de argumentos del comando (no se interpreta con un shell)
         cwd: Directorio de trabajo
         sudo: Si es True, ejecuta el comando con sudo
-    """
-    # Convertir a lista si es necesario
-    if isinstance(cmd, str):
-        cmd = cmd.split()
+        env: Variables de entorno adicionales para el comando
+        capture: Si es True, captura stdout y stderr y los devuelve; si no,
+            el comando escribe directamente en la terminal
     
+    Returns:
+        La salida capturada ('' si no se captura), o None si el comando falla
+    """
     # Añadir sudo si es necesario
     if sudo:
-        cmd = ['sudo'] + cmd
+        cmd = ['sudo', *cmd]
+        if env:
+            # sudo limpia el entorno: las variables se pasan como argumentos
+            cmd = cmd[:1] + [f"{k}={v}" for k, v in env.items()] + cmd[1:]
     
-    try:
-        print(f"Ejecutando: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd, 
-            check=True, 
-            cwd=cwd, 
-            text=True, 
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        if result.stdout:
-            print(result.stdout)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"Error al ejecutar el comando: {' '.join(cmd)}")
-        if e.stdout:
-            print(f"Salida:\n{e.stdout}")
-        if e.stderr:
-            print(f"Error:\n{e.stderr}")
-        return None
-
-def install_system_dependencies():
-    """Instala las dependencias del sistema"""
-    print("\n=== Instalando dependencias del sistema ===")
+    # Entorno del proceso hijo
+    if env:
+        env = {**os.environ, **env}
     
-    # Actualizar lista de paquetes
-    run_command("apt-get update", sudo=True)
+    print(f"Ejecutando: {' '.join(cmd)}")
     
-    # Instalar paquetes necesarios
-    packages = [
-        "python3-pip",
-        "python3-venv",
-        "ffmpeg",
-        "nginx",
-        "git"
-    ]
+    if not capture:
+        # La salida va directamente a la terminal, sin buffers intermedios
+        try:
+            subprocess.run(cmd, check=True, cwd=cwd, env=env)
+            return ''
+        except subprocess.CalledProcessError:
+            print(f"Error al ejecutar el comando: {' '.join(cmd)}")
+            return None
+    
+    # nginx -t/-V escriben en stderr, así que se captura junto con stdout
+    with subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        env=env,
+        bufsize=1024 * 1024,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    ) as proc:
+        output = read_output(proc)
+    
+    if proc.returncode != 0:
+        print(f"Error al ejecutar el comando: {' '.join(cmd)}")
+        if output:
+            print(f"Salida:\n{output}")
+        return None
     
-    for pkg in packages:
-        run_command(f"apt-get install -y {pkg}", sudo=True)
+    if output:
+        print(output)
+    return output
 
-def setup_python_environment():
-    """Configura el entorno virtual de Python"""
-    print("\n=== Configurando entorno virtual de Python ===")
-    
-    # Crear entorno virtual si no existe
-    venv_dir = "venv"
-    if not os.path.exists(venv_dir):
-        print(f"Creando entorno virtual en {venv_dir}")
-        venv.create(venv_dir, with_pip=True)
-    
-    # Activar entorno virtual e instalar dependencias
-    if platform.system() == "Windows":
-        pip_path = os.path.join(venv_dir, "Scripts", "pip")
-    else:
-        pip_path = os.path.join(venv_dir, "bin", "pip")
-    
-    print("Instalando dependencias de Python...")
-    run_command(f"{pip_path} install --upgrade pip")
-    run_command(f"{pip_path} install -r requirements.txt")
+# Indica si ya se actualizó la lista de paquetes en esta ejecución
+_apt_updated = False
 
-def setup_directories():
-    """Crea los directorios necesarios"""
-    print("\n=== Creando estructura de directorios ===")
-    
-    directories = [
-        "multimedia",
-        "app/static/uploads",
-        "app/logs",
-        "/var/www/html/stream/hls"  # Directorio para archivos HLS
-    ]
-    
-    for directory in directories:
-        try:
-            os.makedirs(directory, exist_ok=True)
-            print(f"Directorio creado: {directory}")
-        except Exception as e:
-            print(f"Advertencia: No se pudo crear el directorio {directory}: {e}")
-            print("Es posible que necesites ejecutar con sudo para crear directorios del sistema")
+def ensure_apt_update():
+    """Ejecuta apt-get update una sola vez por ejecución del script"""
+    global _apt_updated
+    if _apt_updated:
+        return
+    # Sin índices de traducciones: se descargan muchos menos datos de los mirrors
+    run_command(['apt-get', 'update', '-o', 'Acquire::Languages=none'], sudo=True)
+    _apt_updated = True
 
-def set_permissions():
-    """Establece los permisos necesarios"""
-    print("\n=== Estableciendo permisos ===")
-    
-    # Permisos para archivos de la aplicación
-    files = ["wsgi.py", "actualizar_m3u.py"]
-    for f in files:
-        if os.path.exists(f):
-            os.chmod(f, 0o755)
+def apt_install(packages):
+    """
+    Instala todos los paquetes en una sola invocación de apt-get.
     
-    # Permisos para directorios del sistema
-    system_dirs = [
-        "/var/www/html/stream",
-        "/var/www/html/stream/hls"
-    ]
+    apt resuelve las dependencias una vez y dpkg ejecuta sus triggers
+    una sola vez, en lugar de repetirlo por cada paquete o lote.
+    """
+    return run_command(
+        ['apt-get', 'install', '-y', '--no-install-recommends',
+         '-o', 'Dpkg::Use-Pty=0', *packages],
+        sudo=True,
+        env={'DEBIAN_FRONTEND': 'noninteractive'}
+    )
+
+def atomic_write(path, content, mode=0o644, uid=0, gid=0):
+    """
+    Escribe un archivo de configuración de forma atómica.
     
-    for directory in system_dirs:
-        try:
-            # Establecer propietario y grupo
-            run_command(['chown', '-R', 'www-data:www-data', directory], sudo=True)
-            # Establecer permisos
-            run_command(['chmod', '-R', '755', directory], sudo=True)
-            print(f"Permisos establecidos para: {directory}")
-        except Exception as e:
-            print(f"Advertencia: No se pudieron establecer permisos para {directory}: {e}")
+    El contenido se escribe con una sola llamada a os.write en un temporal
+    del mismo directorio, se fijan propietario y permisos sobre el descriptor
+    y se publica con os.replace, así nunca queda un archivo a medio escribir.
+    """
+    if isinstance(content, str):
+        content = content.encode()
     
-    # Asegurar que el directorio de multimedia tenga permisos correctos
-    multimedia_dir = os.path.abspath("multimedia")
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
     try:
-        run_command(['chown', '-R', 'www-data:www-data', multimedia_dir], sudo=True)
-        run_command(['chmod', '-R', '755', multimedia_dir], sudo=True)
-        print(f"Permisos establecidos para: {multimedia_dir}")
-    except Exception as e:
-        print(f"Advertencia: No se pudieron establecer permisos para {multimedia_dir}: {e}")
-    
-    # Mensaje de finalización
-    print("=== Configuración de permisos completada ===")
+        view = memoryview(content)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fchmod(fd, mode)
+        os.fchown(fd, uid, gid)
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, path)
 
-def main():
-    """Función principal"""
-    print("=== Configuración de Signage ===")
-    
-    # Verificar si se está ejecutando como root
-    if os.geteuid() != 0:
-        print("\n¡Atención! Este script requiere privilegios de superusuario.")
-        print("Algunos pasos de la instalación podrían fallar.")
-        print("Se recomienda ejecutar con: sudo python3 setup.py")
-        print("\n¿Desea continuar de todos modos? (s/n): ", end="")
-        if input().lower() != 's':
-            print("Instalación cancelada.")
-            sys.exit(1)
-    
-    # Actualizar lista de paquetes
-    print("\nActualizando lista de paquetes...")
-    run_command(['apt-get', 'update'], sudo=True)
-    
-    # Instalar dependencias del sistema
-    print("\nInstalando dependencias del sistema...")
-    dependencies = [
-        'build-essential',
-        'libpcre3',
-        'libpcre3-dev',
-        'libssl-dev',
-        'zlib1g',
-        'zlib1g-dev',
-        'unzip',
-        'ffmpeg',
-        'libavcodec-dev',
-        'libavformat-dev',
-        'libswscale-dev',
-        'libavutil-dev',
-        'libx264-dev',
-        'libx265-dev',
-        'libfdk-aac-dev',
-        'libmp3lame-dev',
-        'libvpx-dev',
-        'libopus-dev',
-        'libass-dev',
-        'libtheora-dev',
-        'libvorbis-dev',
-        'libxcb1-dev',
-        'libxcb-shm0-dev',
-        'libxcb-xfixes0-dev',
-        'pkg-config',
-        'yasm',
-        'git',
-        'wget',
-        'curl',
-        'python3-pip',
-        'python3-venv',
-        'nginx',
-        'supervisor'
-    ]
-    
-    # Instalar dependencias en lotes para evitar errores
-    batch_size = 10
-    for i in range(0, len(dependencies), batch_size):
-        batch = dependencies[i:i + batch_size]
-        run_command(['apt-get', 'install', '-y', '--no-install-recommends'] + batch, sudo=True)
-    
-    # Configurar entorno Python
-    setup_python_environment()
-    
-    # Crear directorios necesarios
-    setup_directories()
-    
-    # Establecer permisos
-    set_permissions()
-    
-    # Instalar FileBrowser
-    install_filebrowser()
-    
-    # Configurar Nginx con soporte RTMP
-    print("\n=== Configurando Nginx con soporte RTMP ===")
-    
-    # Instalar dependencias de Nginx y RTMP
-    run_command(['apt-get', 'install', '-y', 'nginx', 'libnginx-mod-rtmp'], sudo=True)
-    
-    # Configuración RTMP y HTTP unificada en un solo archivo
-    
-    # Crear directorios necesarios
-    stream_dir = '/var/www/html/stream'
-    hls_dir = os.path.join(stream_dir, 'hls')
-    
-    run_command(['mkdir', '-p', hls_dir], sudo=True)
-    run_command(['chown', '-R', 'www-data:www-data', stream_dir], sudo=True)
-    run_command(['chmod', '-R', '755', stream_dir], sudo=True)
-    
-    # Hacer una copia de seguridad del archivo de configuración actual si existe
-    if os.path.exists('/etc/nginx/nginx.conf'):
-        backup_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_file = f'/etc/nginx/nginx.conf.backup_{backup_time}'
-        run_command(['cp', '/etc/nginx/nginx.conf', backup_file], sudo=True)
-        print(f"✓ Copia de seguridad creada en {backup_file}")
+NGINX_BINARY = '/usr/sbin/nginx'
+
+def nginx_has_configure_flag(flag):
+    """
+    Comprueba si nginx se compiló con una opción de configure.
     
-    # Crear configuración principal de Nginx limpia
-    main_nginx_conf = """# Configuración principal de Nginx
+    Busca la cadena en el propio binario (es la misma que imprime `nginx -V`),
+    sin lanzar ningún proceso.
+    """
+    try:
+        with open(NGINX_BINARY, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return data.find(flag.encode()) != -1
+    except (OSError, ValueError):
+        return False
+
+# Configuración principal de Nginx con RTMP (/etc/nginx/nginx.conf)
+NGINX_CONF = """# Configuración principal de Nginx
 user www-data;
 worker_processes auto;
 pid /run/nginx.pid;
@@ -373,70 +304,9 @@ http {
     }
 }
 """
-    
-    # Guardar la configuración principal de Nginx
-    with open('/etc/nginx/nginx.conf', 'w') as f:
-        f.write(main_nginx_conf)
-    
-    # Asegurar que los permisos sean correctos
-    run_command(['chmod', '644', '/etc/nginx/nginx.conf'], sudo=True)
-    run_command(['chown', 'root:root', '/etc/nginx/nginx.conf'], sudo=True)
-    
-    # Verificar configuración
-    print("Verificando configuración de Nginx...")
-    
-    # Verificar si el módulo RTMP está instalado
-    rtmp_installed = run_command(['dpkg', '-l', 'libnginx-mod-rtmp'], sudo=True)
-    if "no packages found" in rtmp_installed.lower():
-        print("✗ El módulo RTMP no está instalado")
-        print("Instalando módulo RTMP...")
-        run_command(['apt-get', 'update'], sudo=True)
-        run_command(['apt-get', 'install', '-y', 'libnginx-mod-rtmp'], sudo=True)
-    else:
-        print("✓ Módulo RTMP ya está instalado")
-    
-    # Verificar si el módulo se cargó correctamente
-    nginx_v = run_command(['nginx', '-V'], sudo=True)
-    if "with-http_ssl_module" not in nginx_v:
-        print("✗ Módulo SSL no encontrado, instalando...")
-        run_command(['apt-get', 'install', '-y', 'nginx-extras'], sudo=True)
-    
-    # Verificar la configuración
-    test_result = run_command(['nginx', '-t'], sudo=True)
-    if test_result and "test is successful" in test_result:
-        print("✓ Configuración de Nginx verificada correctamente")
-        # Reiniciar Nginx
-        run_command(['systemctl', 'restart', 'nginx'], sudo=True)
-        print("✓ Nginx reiniciado con la nueva configuración")
-    else:
-        print("✗ Error en la configuración de Nginx.")
-        print("=== Detalles del error ===")
-        print(test_result or "No se pudo obtener el error. Verifica los logs manualmente.")
-        print("=========================")
-        print("Puedes revisar los logs con: sudo tail -f /var/log/nginx/error.log")
-        print("Configuración actual cargada:")
-        print(result or "No se pudo cargar la configuración")
-        sys.exit(1)
-    
-    # Configuración finalizada
-    print("\n=== Configuración completada ===")
-    print("Nginx ha sido configurado con soporte RTMP.")
-    print("Puedes iniciar una transmisión con:")
-    print("ffmpeg -re -i tu_video.mp4 -c:v libx264 -preset veryfast -f flv rtmp://tu_servidor/live/tu_stream")
-    print("Y verla en: http://tu_servidor/hls/tu_stream.m3u8")
-    
-    # Obtener la IP del servidor
-    try:
-        ip = get_local_ip()
-        if ip:
-            print(f"\nTu dirección IP local es: {ip}")
-            print(f"URL de transmisión: rtmp://{ip}/live/tu_stream")
-            print(f"URL de reproducción: http://{ip}/hls/tu_stream.m3u8")
-    except Exception as e:
-        print(f"No se pudo obtener la dirección IP: {e}")
 
-    # Configuración del servidor web
-    nginx_web_config = """
+# Configuración del servidor web (/etc/nginx/sites-available/default)
+NGINX_SITE_CONF = """
 server {
     listen 80;
     server_name _;
@@ -472,34 +342,451 @@ server {
     }
 }
 """
+
+def get_nginx_modules(conf):
+    """Devuelve las directivas load_module de una configuración de Nginx"""
+    return [line.strip() for line in conf.splitlines()
+            if line.strip().startswith('load_module')]
+
+def install_system_dependencies():
+    """Instala las dependencias del sistema"""
+    print("\n=== Instalando dependencias del sistema ===")
+    
+    # Actualizar lista de paquetes
+    ensure_apt_update()
+    
+    # Instalar paquetes necesarios
+    packages = [
+        "python3-pip",
+        "python3-venv",
+        "ffmpeg",
+        "nginx",
+        "git"
+    ]
+    
+    apt_install(packages)
+
+# Paquetes de arranque de pip que se guardan en la caché de semillas del venv
+VENV_SEED_PACKAGES = ('pip', 'setuptools', 'wheel', '_distutils_hack',
+                      'pkg_resources', 'distutils-precedence.pth')
+
+def get_site_packages(venv_dir):
+    """Devuelve el directorio site-packages del entorno virtual"""
+    if platform.system() == "Windows":
+        return os.path.join(venv_dir, "Lib", "site-packages")
+    version = f"python{sys.version_info.major}.{sys.version_info.minor}"
+    return os.path.join(venv_dir, "lib", version, "site-packages")
+
+def get_venv_seed_dir():
+    """
+    Directorio de caché con pip/setuptools ya desempaquetados.
+    
+    La clave depende del intérprete y de su versión, de modo que una
+    actualización de Python invalida la caché.
+    """
+    key = hashlib.sha256(f"{sys.executable}\0{sys.version}".encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser('~'), '.cache', 'signally', 'venv-seed', key)
+
+# Script de consola de pip, igual al que genera pip al instalarse
+PIP_SCRIPT = """#!{python}
+# -*- coding: utf-8 -*-
+import re
+import sys
+from pip._internal.cli.main import main
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit(main())
+"""
+
+def write_pip_scripts(venv_dir):
+    """
+    Crea bin/pip, bin/pip3 y bin/pipX.Y en un venv sembrado desde la caché.
+    
+    Al copiar solo site-packages no se generan los scripts de consola, y sin
+    ellos `pip` dentro del venv activado resolvería al pip del sistema.
+    """
+    if platform.system() == "Windows":
+        # En Windows los lanzadores son .exe; ahí se usa `python -m pip`
+        return
+    bin_dir = os.path.join(venv_dir, "bin")
+    script = PIP_SCRIPT.format(python=os.path.abspath(os.path.join(bin_dir, "python")))
+    major, minor = sys.version_info[:2]
+    for name in ("pip", f"pip{major}", f"pip{major}.{minor}"):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+def create_venv(venv_dir):
+    """
+    Crea el entorno virtual reutilizando la semilla de pip en caché.
+    
+    La primera vez se usa ensurepip y se guarda el resultado; las siguientes
+    se crea el venv sin pip y se copian los paquetes de la caché, evitando
+    el subproceso de ensurepip.
+    
+    El intérprete se enlaza con symlinks en lugar de copiarse. Si el venv
+    se va a mover a otra ruta, exportar SIGNALLY_VENV_COPIES=1 para copiar
+    los binarios.
+    """
+    seed_dir = get_venv_seed_dir()
+    site_packages = get_site_packages(venv_dir)
+    symlinks = (platform.system() != "Windows"
+                and os.environ.get('SIGNALLY_VENV_COPIES') != '1')
+    
+    if os.path.isdir(seed_dir):
+        print(f"Usando semilla de pip en caché: {seed_dir}")
+        venv.EnvBuilder(with_pip=False, symlinks=symlinks).create(venv_dir)
+        shutil.copytree(seed_dir, site_packages, symlinks=True, dirs_exist_ok=True)
+        write_pip_scripts(venv_dir)
+        return
+    
+    venv.EnvBuilder(system_site_packages=False, clear=False, symlinks=symlinks,
+                    with_pip=True).create(venv_dir)
+    
+    # Guardar la semilla en un directorio temporal y publicarla con rename
+    tmp_dir = f"{seed_dir}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(seed_dir), exist_ok=True)
+        os.makedirs(tmp_dir, exist_ok=True)
+        for entry in os.scandir(site_packages):
+            if not entry.name.startswith(VENV_SEED_PACKAGES):
+                continue
+            dst = os.path.join(tmp_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                shutil.copytree(entry.path, dst, symlinks=True)
+            else:
+                shutil.copy2(entry.path, dst)
+        os.rename(tmp_dir, seed_dir)
+    except OSError as e:
+        print(f"Advertencia: No se pudo guardar la semilla de pip en caché: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def setup_python_environment():
+    """Configura el entorno virtual de Python"""
+    print("\n=== Configurando entorno virtual de Python ===")
+    
+    # Crear entorno virtual si no existe
+    venv_dir = "venv"
+    if not os.path.exists(venv_dir):
+        print(f"Creando entorno virtual en {venv_dir}")
+        create_venv(venv_dir)
+    
+    # pip se invoca como módulo: con la semilla en caché no hay script bin/pip
+    if platform.system() == "Windows":
+        python_path = os.path.join(venv_dir, "Scripts", "python")
+    else:
+        python_path = os.path.join(venv_dir, "bin", "python")
+    pip_cmd = [python_path, '-m', 'pip']
+    
+    print("Instalando dependencias de Python...")
+    # Actualizar pip solo si se pide explícitamente (PIP_UPGRADE=1)
+    if os.environ.get('PIP_UPGRADE') == '1':
+        run_command(pip_cmd + ['install', '--upgrade', 'pip'])
+    run_command(pip_cmd + ['install', '--no-cache-dir', '--disable-pip-version-check',
+                           '-r', 'requirements.txt'])
+
+def setup_directories():
+    """Crea los directorios necesarios"""
+    print("\n=== Creando estructura de directorios ===")
+    
+    directories = [
+        "multimedia",
+        "app/static/uploads",
+        "app/logs",
+        "/var/www/html/stream/hls"  # Directorio para archivos HLS
+    ]
+    
+    for directory in directories:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            print(f"Directorio creado: {directory}")
+        except Exception as e:
+            print(f"Advertencia: No se pudo crear el directorio {directory}: {e}")
+            print("Es posible que necesites ejecutar con sudo para crear directorios del sistema")
+
+@functools.lru_cache(maxsize=1)
+def get_www_data_ids():
+    """Devuelve (uid, gid) de www-data:www-data, o None si no existe"""
+    try:
+        import grp
+        import pwd
+        return pwd.getpwnam('www-data').pw_uid, grp.getgrnam('www-data').gr_gid
+    except (ImportError, KeyError):
+        return None
+
+def fix_entry(name, dir_fd, ids, mode):
+    """
+    Ajusta propietario y permisos de una entrada relativa a dir_fd.
+    
+    Solo hace chown/chmod si los valores actuales no coinciden, de modo que
+    en un árbol ya configurado cada entrada cuesta un único fstatat. Con
+    mode=None solo se cambia el propietario.
+    
+    Devuelve False si la entrada desapareció entretanto (p. ej. un segmento
+    HLS borrado por hls_cleanup), en cuyo caso simplemente se omite.
+    """
+    uid, gid = ids
+    try:
+        st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        if (st.st_uid, st.st_gid) != ids:
+            os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+        if mode is not None and not stat.S_ISLNK(st.st_mode) and stat.S_IMODE(st.st_mode) != mode:
+            os.chmod(name, mode, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return False
+    return True
+
+def apply_tree_permissions(root, ids, mode=0o755):
+    """
+    Equivalente en proceso a `chown -R` + `chmod -R` sobre un árbol.
+    
+    Recorre el árbol una sola vez con os.scandir sobre descriptores de
+    directorio, de modo que cada operación es relativa (fstatat, fchownat,
+    fchmodat) y el kernel no resuelve la ruta completa en cada llamada.
+    Si el script no corre como root recurre a chown/chmod con sudo.
+    """
+    uid, gid = ids
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+    pending = []
+    try:
+        fix_entry(root, None, ids, mode)
+        pending.append(os.open(root, flags))
+        while pending:
+            dir_fd = pending.pop()
+            try:
+                with os.scandir(dir_fd) as it:
+                    for entry in it:
+                        if not fix_entry(entry.name, dir_fd, ids, mode):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            try:
+                                pending.append(os.open(entry.name, flags, dir_fd=dir_fd))
+                            except FileNotFoundError:
+                                # El directorio se borró después de listarlo
+                                continue
+            finally:
+                os.close(dir_fd)
+    except PermissionError:
+        if os.geteuid() == 0:
+            raise
+        run_command(['chown', '-R', f'{uid}:{gid}', root], sudo=True)
+        if mode is not None:
+            run_command(['chmod', '-R', f'{mode:o}', root], sudo=True)
+    finally:
+        for dir_fd in pending:
+            os.close(dir_fd)
+
+def set_permissions():
+    """Establece los permisos necesarios"""
+    print("\n=== Estableciendo permisos ===")
+    
+    # Permisos para archivos de la aplicación
+    files = ["wsgi.py", "actualizar_m3u.py"]
+    for f in files:
+        try:
+            os.chmod(f, 0o755)
+        except FileNotFoundError:
+            pass
+    
+    ids = get_www_data_ids()
+    if ids is None:
+        print("Advertencia: El usuario www-data no existe, no se establecen permisos")
+        return
+    
+    # Directorios del sistema y de multimedia, sin repetir subárboles ya incluidos
+    directories = sorted({
+        os.path.realpath("/var/www/html/stream"),
+        os.path.realpath("/var/www/html/stream/hls"),
+        os.path.realpath("multimedia")
+    })
+    roots = []
+    for directory in directories:
+        if not any(directory.startswith(root + os.sep) for root in roots):
+            roots.append(directory)
+    
+    for directory in roots:
+        try:
+            apply_tree_permissions(directory, ids)
+            print(f"Permisos establecidos para: {directory}")
+        except Exception as e:
+            print(f"Advertencia: No se pudieron establecer permisos para {directory}: {e}")
+    
+    # Mensaje de finalización
+    print("=== Configuración de permisos completada ===")
+
+def main():
+    """Función principal"""
+    print("=== Configuración de Signage ===")
+    
+    # Verificar si se está ejecutando como root
+    if os.geteuid() != 0:
+        print("\n¡Atención! Este script requiere privilegios de superusuario.")
+        print("Algunos pasos de la instalación podrían fallar.")
+        print("Se recomienda ejecutar con: sudo python3 setup.py")
+        print("\n¿Desea continuar de todos modos? (s/n): ", end="")
+        if input().lower() != 's':
+            print("Instalación cancelada.")
+            sys.exit(1)
+    
+    # Descargar FileBrowser en segundo plano mientras apt trabaja
+    downloads = ThreadPoolExecutor(max_workers=1)
+    filebrowser_download = downloads.submit(fetch_filebrowser)
+    
+    # Actualizar lista de paquetes
+    print("\nActualizando lista de paquetes...")
+    ensure_apt_update()
+    
+    # Instalar dependencias del sistema
+    print("\nInstalando dependencias del sistema...")
+    dependencies = [
+        'build-essential',
+        'libpcre3',
+        'libpcre3-dev',
+        'libssl-dev',
+        'zlib1g',
+        'zlib1g-dev',
+        'unzip',
+        'ffmpeg',
+        'libavcodec-dev',
+        'libavformat-dev',
+        'libswscale-dev',
+        'libavutil-dev',
+        'libx264-dev',
+        'libx265-dev',
+        'libfdk-aac-dev',
+        'libmp3lame-dev',
+        'libvpx-dev',
+        'libopus-dev',
+        'libass-dev',
+        'libtheora-dev',
+        'libvorbis-dev',
+        'libxcb1-dev',
+        'libxcb-shm0-dev',
+        'libxcb-xfixes0-dev',
+        'pkg-config',
+        'yasm',
+        'git',
+        'wget',
+        'curl',
+        'python3-pip',
+        'python3-venv',
+        'nginx',
+        'libnginx-mod-rtmp',
+        'supervisor'
+    ]
+    
+    # Instalar todas las dependencias en una sola transacción de apt
+    apt_install(dependencies)
+    
+    # Configurar entorno Python
+    setup_python_environment()
+    
+    # Crear directorios necesarios
+    setup_directories()
+    
+    # Establecer permisos
+    set_permissions()
+    
+    # Instalar FileBrowser
+    filebrowser_installed = install_filebrowser(filebrowser_download)
+    downloads.shutdown()
+    
+    # Configurar Nginx con soporte RTMP
+    print("\n=== Configurando Nginx con soporte RTMP ===")
+    
+    # Configuración RTMP y HTTP unificada en un solo archivo
+    
+    # Crear directorios necesarios
+    stream_dir = '/var/www/html/stream'
+    hls_dir = os.path.join(stream_dir, 'hls')
+    
+    run_command(['mkdir', '-p', hls_dir], sudo=True)
+    ids = get_www_data_ids()
+    if ids:
+        try:
+            apply_tree_permissions(stream_dir, ids)
+        except Exception as e:
+            print(f"Advertencia: No se pudieron establecer permisos para {stream_dir}: {e}")
+    
+    # Hacer una copia de seguridad del archivo de configuración actual si existe
+    backup_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_file = f'/etc/nginx/nginx.conf.backup_{backup_time}'
+    try:
+        shutil.copy2('/etc/nginx/nginx.conf', backup_file)
+        print(f"✓ Copia de seguridad creada en {backup_file}")
+    except FileNotFoundError:
+        pass
+    
+    # Verificar si nginx se compiló con SSL
+    if not nginx_has_configure_flag('--with-http_ssl_module'):
+        print("✗ Módulo SSL no encontrado, instalando...")
+        apt_install(['nginx-extras'])
     
-    # Guardar configuración del servidor web
-    with open('/etc/nginx/sites-available/default', 'w') as f:
-        f.write(nginx_web_config)
+    # Con cambios solo de configuración basta un reload (no cierra conexiones);
+    # si cambian los módulos cargados hace falta reiniciar el proceso maestro
+    try:
+        with open('/etc/nginx/nginx.conf') as f:
+            previous_conf = f.read()
+    except OSError:
+        previous_conf = ''
+    needs_restart = get_nginx_modules(previous_conf) != get_nginx_modules(NGINX_CONF)
+    
+    # Guardar la configuración principal (root:root, 644) y la del servidor web
+    atomic_write('/etc/nginx/nginx.conf', NGINX_CONF)
+    atomic_write('/etc/nginx/sites-available/default', NGINX_SITE_CONF)
     
     # Crear enlace simbólico si no existe
-    if not os.path.exists('/etc/nginx/sites-enabled/default'):
-        run_command(['ln', '-s', '/etc/nginx/sites-available/default', '/etc/nginx/sites-enabled/'], sudo=True)
+    try:
+        os.symlink('/etc/nginx/sites-available/default', '/etc/nginx/sites-enabled/default')
+    except FileExistsError:
+        pass
     
-    # Verificar configuración de Nginx
-    result = run_command(['nginx', '-t'], sudo=True)
-    if result is not None and "test is successful" in result:
+    # Verificar la configuración una sola vez
+    print("Verificando configuración de Nginx...")
+    test_result = run_command(['nginx', '-t'], sudo=True, capture=True)
+    if test_result and "test is successful" in test_result:
         print("✓ Configuración de Nginx verificada correctamente")
-        # Reiniciar Nginx
-        run_command(['systemctl', 'restart', 'nginx'], sudo=True)
-        print("✓ Nginx reiniciado con la nueva configuración")
+        if needs_restart:
+            run_command(['systemctl', 'restart', 'nginx'], sudo=True)
+            print("✓ Nginx reiniciado con la nueva configuración")
+        else:
+            run_command(['systemctl', 'reload-or-restart', 'nginx'], sudo=True)
+            print("✓ Nginx recargado con la nueva configuración")
     else:
-        print("✗ Error en la configuración de Nginx. Verifica los logs.")
+        print("✗ Error en la configuración de Nginx.")
+        print("=== Detalles del error ===")
+        print(test_result or "No se pudo obtener el error. Verifica los logs manualmente.")
+        print("=========================")
+        print("Puedes revisar los logs con: sudo tail -f /var/log/nginx/error.log")
+        print("Configuración actual en: /etc/nginx/nginx.conf")
         sys.exit(1)
     
-    # Configuración de Nginx RTMP
-    with open('/etc/nginx/nginx.conf', 'w') as f:
-        f.write(nginx_conf)
+    # Configuración finalizada
+    print("\n=== Configuración completada ===")
+    print("Nginx ha sido configurado con soporte RTMP.")
+    print("Puedes iniciar una transmisión con:")
+    print("ffmpeg -re -i tu_video.mp4 -c:v libx264 -preset veryfast -f flv rtmp://tu_servidor/live/tu_stream")
+    print("Y verla en: http://tu_servidor/hls/tu_stream.m3u8")
     
+    # Obtener la IP del servidor
+    try:
+        ip = get_local_ip()
+        if ip:
+            print(f"\nTu dirección IP local es: {ip}")
+            print(f"URL de transmisión: rtmp://{ip}/live/tu_stream")
+            print(f"URL de reproducción: http://{ip}/hls/tu_stream.m3u8")
+    except Exception as e:
+        print(f"No se pudo obtener la dirección IP: {e}")
+
     # Crear directorio para logs de Nginx si no existe
     run_command(['mkdir', '-p', '/var/log/nginx/'], sudo=True)
     run_command(['touch', '/var/log/nginx/access.log', '/var/log/nginx/error.log'], sudo=True)
-    run_command(['chown', '-R', 'www-data:www-data', '/var/log/nginx/'], sudo=True)
+    if ids:
+        try:
+            apply_tree_permissions('/var/log/nginx', ids, mode=None)
+        except Exception as e:
+            print(f"Advertencia: No se pudieron establecer permisos para /var/log/nginx: {e}")
     
     # Configurar Nginx para iniciar automáticamente
     print("Configurando Nginx para inicio automático...")
@@ -526,31 +813,44 @@ WantedBy=multi-user.target
 """
     
     # Guardar configuración del servicio
-    with open('/etc/systemd/system/nginx.service', 'w') as f:
-        f.write(nginx_service)
+    atomic_write('/etc/systemd/system/nginx.service', nginx_service)
     
-    # Recargar systemd y habilitar Nginx
+    # Recargar systemd una vez y habilitar e iniciar todos los servicios en una llamada
+    units = ['nginx']
+    if filebrowser_installed:
+        units.append('filebrowser.service')
+    print("Iniciando servicios...")
     run_command(['systemctl', 'daemon-reload'], sudo=True)
-    run_command(['systemctl', 'enable', 'nginx'], sudo=True)
-    
-    # Iniciar Nginx
-    print("Iniciando Nginx...")
-    run_command(['systemctl', 'start', 'nginx'], sudo=True)
+    services_started = run_command(['systemctl', 'enable', '--now', *units], sudo=True)
     
     # Verificar estado de Nginx
-    run_command(['systemctl', 'status', 'nginx', '--no-pager'], sudo=True)
+    nginx_active = subprocess.run(['systemctl', 'is-active', '--quiet', 'nginx'], check=False)
+    if nginx_active.returncode == 0:
+        print("✓ Nginx está en ejecución")
+    else:
+        print("✗ Nginx no está en ejecución. Revisa: sudo systemctl status nginx")
+    
+    if filebrowser_installed and services_started is not None:
+        print("\n¡FileBrowser instalado y configurado correctamente!")
+        print(f"Accede a FileBrowser en: http://{get_local_ip()}:8085")
+        print("Usuario por defecto: admin")
+        print("Contraseña por defecto: admin")
+        print("\nPor seguridad, cambia la contraseña después del primer inicio de sesión.")
     
     # Configurar cron job para el gestor de videos
     print("\nConfigurando cron job para el gestor de videos...")
     log_file = os.path.join(os.path.expanduser('~'), 'video_stream.log')
     cron_command = f"* * * * * /usr/bin/python3 /usr/local/bin/video_stream_manager.py >> {log_file} 2>&1"
-    cron_job = f"(crontab -l 2>/dev/null | grep -v 'video_stream_manager.py'; echo '{cron_command}') | crontab -"
     print(f"Comando cron: {cron_command}")
     
     try:
-        subprocess.run(cron_job, shell=True, check=True)
+        # Leer el crontab actual (vacío si el usuario aún no tiene) y sustituir la entrada
+        existing = subprocess.run(['crontab', '-l'], capture_output=True).stdout.decode()
+        lines = [line for line in existing.splitlines() if 'video_stream_manager.py' not in line]
+        lines.append(cron_command)
+        subprocess.run(['crontab', '-'], input=('\n'.join(lines) + '\n').encode(), check=True)
         print("Cron job configurado correctamente.")
-    except subprocess.CalledProcessError as e:
+    except (OSError, subprocess.CalledProcessError) as e:
         print(f"Error al configurar el cron job: {e}")
     
     # Copiar el script de gestión de videos si no existe
@@ -608,44 +908,105 @@ WantedBy=multi-user.target
     print("="*80)
     print("\nColoca tus videos en la carpeta 'multimedia' y se transmitirán automáticamente.")
 
-def install_filebrowser():
-    """Instala y configura FileBrowser"""
+# Versión de FileBrowser a instalar (puedes actualizar esto a la última versión)
+FILEBROWSER_VERSION = 'v2.23.0'
+FILEBROWSER_DIR = '/opt/filebrowser'
+
+def download_file(url, dest, chunk_size=1024 * 1024):
+    """
+    Descarga una URL a disco en bloques de 1 MiB.
+    
+    El buffer de recepción del socket se deja al autoajuste del kernel: fijar
+    SO_RCVBUF lo desactiva y limita la ventana TCP a net.core.rmem_max.
+    """
+    print(f"Descargando {url}")
+    with urllib.request.urlopen(url, timeout=60) as response:
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            while True:
+                n = response.readinto(buf)
+                if not n:
+                    break
+                pending = view[:n]
+                while pending:
+                    pending = pending[os.write(fd, pending):]
+        finally:
+            os.close(fd)
+    return dest
+
+def fetch_filebrowser():
+    """
+    Descarga el paquete de FileBrowser para la arquitectura del sistema.
+    
+    Solo hace la parte de red, para poder lanzarla en segundo plano
+    mientras apt instala las dependencias. Devuelve la ruta del archivo
+    descargado o None si la arquitectura no está soportada.
+    """
+    # Determinar la arquitectura del sistema
+    arch = platform.machine().lower()
+    if arch in ['x86_64', 'amd64']:
+        arch = 'linux-amd64'
+    elif arch in ['arm', 'armv7l']:
+        arch = 'linux-arm7'
+    elif arch == 'aarch64':
+        arch = 'linux-arm64'
+    else:
+        print(f"Arquitectura no soportada: {arch}. Instalación de FileBrowser omitida.")
+        return None
+    
+    # Crear directorio para FileBrowser
+    os.makedirs(FILEBROWSER_DIR, exist_ok=True)
+    
+    # Descargar FileBrowser
+    fb_url = f'https://github.com/filebrowser/filebrowser/releases/download/{FILEBROWSER_VERSION}/filebrowser-{arch}.tar.gz'
+    fb_archive = os.path.join(FILEBROWSER_DIR, 'filebrowser.tar.gz')
+    return download_file(fb_url, fb_archive)
+
+def extract_binary(archive, name, dest):
+    """
+    Extrae un único ejecutable de un .tar.gz en una sola pasada.
+    
+    El tar se lee en modo flujo y el miembro se copia a un temporal junto a
+    dest, que luego se publica con os.replace: así se puede actualizar el
+    binario aunque el servicio lo esté ejecutando.
+    """
+    tmp_path = f"{dest}.tmp"
+    with tarfile.open(archive, 'r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or os.path.basename(member.name) != name:
+                continue
+            src = tar.extractfile(member)
+            with open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, length=1 << 20)
+                os.fchmod(dst.fileno(), 0o755)
+            os.replace(tmp_path, dest)
+            return dest
+    raise FileNotFoundError(f"{name} no encontrado en {archive}")
+
+def install_filebrowser(download=None):
+    """
+    Instala y configura FileBrowser
+    
+    Args:
+        download: Future de una descarga lanzada con fetch_filebrowser();
+            si es None, la descarga se hace aquí
+    """
     print("\nInstalando FileBrowser...")
     
-    # Obtener la última versión de FileBrowser
     try:
-        print("Obteniendo la última versión de FileBrowser...")
-        filebrowser_version = 'v2.23.0'  # Puedes actualizar esto a la última versión
-        
-        # Determinar la arquitectura del sistema
-        arch = platform.machine().lower()
-        if arch in ['x86_64', 'amd64']:
-            arch = 'linux-amd64'
-        elif arch in ['arm', 'armv7l']:
-            arch = 'linux-arm7'
-        elif arch == 'aarch64':
-            arch = 'linux-arm64'
-        else:
-            print(f"Arquitectura no soportada: {arch}. Instalación de FileBrowser omitida.")
+        print(f"Obteniendo FileBrowser {FILEBROWSER_VERSION}...")
+        fb_archive = download.result() if download else fetch_filebrowser()
+        if fb_archive is None:
             return
-            
-        # Crear directorio para FileBrowser
-        fb_dir = '/opt/filebrowser'
-        os.makedirs(fb_dir, exist_ok=True)
-        
-        # Descargar FileBrowser
-        fb_url = f'https://github.com/filebrowser/filebrowser/releases/download/{filebrowser_version}/filebrowser-{arch}.tar.gz'
-        fb_archive = os.path.join(fb_dir, 'filebrowser.tar.gz')
-        download_file(fb_url, fb_archive)
         
-        # Extraer archivos
+        # Extraer solo el binario directamente en /usr/local/bin
         print("Extrayendo FileBrowser...")
-        with tarfile.open(fb_archive, 'r:gz') as tar:
-            tar.extractall(path=fb_dir)
-        
-        # Mover el binario a /usr/local/bin
-        run_command(['mv', os.path.join(fb_dir, 'filebrowser'), '/usr/local/bin/'], sudo=True)
-        run_command(['chmod', '+x', '/usr/local/bin/filebrowser'], sudo=True)
+        try:
+            extract_binary(fb_archive, 'filebrowser', '/usr/local/bin/filebrowser')
+        finally:
+            os.unlink(fb_archive)
         
         # Crear directorio de configuración
         config_dir = '/etc/filebrowser'
@@ -662,9 +1023,7 @@ def install_filebrowser():
             "root": "/home/signage/multimedia"
         }
         
-        with open('temp_config.json', 'w') as f:
-            json.dump(config, f, indent=4)
-        run_command(['mv', 'temp_config.json', config_path], sudo=True)
+        atomic_write(config_path, json.dumps(config, indent=4))
         
         # Crear servicio systemd
         service_content = """[Unit]
@@ -680,21 +1039,10 @@ Restart=on-failure
 WantedBy=multi-user.target
 """
         
-        with open('filebrowser.service', 'w') as f:
-            f.write(service_content)
-            
-        run_command(['mv', 'filebrowser.service', '/etc/systemd/system/'], sudo=True)
+        atomic_write('/etc/systemd/system/filebrowser.service', service_content)
         
-        # Recargar systemd y habilitar el servicio
-        run_command(['systemctl', 'daemon-reload'], sudo=True)
-        run_command(['systemctl', 'enable', 'filebrowser.service'], sudo=True)
-        run_command(['systemctl', 'start', 'filebrowser.service'], sudo=True)
-        
-        print("\n¡FileBrowser instalado y configurado correctamente!")
-        print(f"Accede a FileBrowser en: http://{get_local_ip()}:8085")
-        print("Usuario por defecto: admin")
-        print("Contraseña por defecto: admin")
-        print("\nPor seguridad, cambia la contraseña después del primer inicio de sesión.")
+        # El servicio se habilita e inicia junto con Nginx al final de main(),
+        # que es también donde se informa de que quedó instalado
         
     except Exception as e:
         print(f"Error al instalar FileBrowser: {e}")
@@ -702,8 +1050,43 @@ WantedBy=multi-user.target
     
     return True
 
+# ioctl de Linux para obtener la dirección IPv4 de una interfaz
+SIOCGIFADDR = 0x8915
+
+def get_interface_ip():
+    """
+    Obtiene la IPv4 de la primera interfaz distinta de loopback.
+    
+    Usa ioctl(SIOCGIFADDR), que consulta al kernel sin enviar paquetes
+    ni depender de la tabla de rutas. Devuelve None si no es posible.
+    """
+    if fcntl is None or not hasattr(socket, 'if_nameindex'):
+        return None
+    
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            if name == 'lo':
+                continue
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR,
+                                    struct.pack('256s', name[:15].encode()))
+            except OSError:
+                # Interfaz sin dirección IPv4
+                continue
+            return socket.inet_ntoa(ifreq[20:24])
+    return None
+
+@functools.lru_cache(maxsize=1)
 def get_local_ip():
     """Obtiene la dirección IP local del servidor"""
+    try:
+        ip = get_interface_ip()
+        if ip:
+            return ip
+    except OSError:
+        pass
+    
+    s = None
     try:
         # Crear un socket para obtener la IP local
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -714,7 +1097,8 @@ def get_local_ip():
     except Exception:
         ip = '127.0.0.1'
     finally:
-        s.close()
+        if s is not None:
+            s.close()
     return ip
 
 if __name__ == "__main__":
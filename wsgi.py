@@ -6,19 +6,29 @@ This file is used by Gunicorn and other WSGI servers to serve the application.
 
 import os
 import sys
-from pathlib import Path
 
 # Asegurarse de que el directorio del proyecto esté en el PYTHONPATH
-project_dir = str(Path(__file__).parent.absolute())
+project_dir = os.path.dirname(os.path.abspath(__file__))
 if project_dir not in sys.path:
     sys.path.insert(0, project_dir)
 
+# Precompilar el bytecode de app/ antes de importarla (SIGNALLY_PRECOMPILE=1),
+# útil en el primer arranque tras una instalación o actualización
+if os.environ.get('SIGNALLY_PRECOMPILE') == '1':
+    import compileall
+    compileall.compile_dir(os.path.join(project_dir, 'app'), quiet=2, workers=0)
+
 # Importar la aplicación Flask
 from app import create_app
 
 # Crear la instancia de la aplicación Flask
 application = create_app()
 
+# Compilar todas las plantillas al cargar el módulo: con `gunicorn --preload`
+# el proceso maestro las deja en memoria compartida (copy-on-write) con los workers
+for nombre in application.jinja_env.list_templates():
+    application.jinja_env.get_template(nombre)
+
 if __name__ == "__main__":
     # Ejecutar la aplicación en modo desarrollo
     application.run(host='0.0.0.0', port=5000, debug=True)